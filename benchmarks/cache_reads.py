@@ -0,0 +1,53 @@
+# Compares plain pickled and compressed url cache entries for the fixture pages: stored size and the time to read a
+# page back, from the database and deserialized. The shipped dictionary was trained on these same pages, so expect
+# a little less from it on the rest of lparchive. Run from the repository root: python -m benchmarks.cache_reads
+import asyncio
+import os
+import pickle
+import tempfile
+import time
+from importlib.resources import files
+
+from aiohttp_client_cache import CachedResponse, SQLiteBackend
+from yarl import URL
+
+import tests.resources as resources
+from lparchive2epub.compression import CompressingSerializer
+
+PAGES = ["Dwarf Fortress - Headshoots.html", "Resident Evil 1.html", "X-COM_ Terror from the Deep.html"]
+RUNS = 500
+
+
+def cached_page(name: str) -> CachedResponse:
+    return CachedResponse(method="GET", reason="OK", status=200, url=URL(f"https://lparchive.org/{name}"),
+                          version="1.1", body=files(resources).joinpath(name).read_bytes(),
+                          raw_headers=((b"Content-Type", b"text/html; charset=utf-8"),))
+
+
+async def measure(cache: SQLiteBackend, responses: list[CachedResponse]) -> tuple[int, float]:
+    for i, response in enumerate(responses):
+        await cache.responses.write(str(i), response)
+    async with cache.responses.get_connection() as db:
+        cursor = await db.execute("SELECT SUM(length(value)) FROM responses")
+        size = (await cursor.fetchone())[0]
+    started = time.perf_counter()
+    for n in range(RUNS):
+        response = await cache.responses.read(str(n % len(responses)))
+        assert response.content_type == "text/html"
+    return size, (time.perf_counter() - started) / RUNS
+
+
+async def main():
+    responses = [cached_page(x) for x in PAGES]
+    print(f"{len(responses)} pages, {sum(len(x._body) for x in responses) / 1024:.1f} KB of html")
+    with tempfile.TemporaryDirectory() as directory:
+        for name, serializer in [("plain", pickle), ("deflate", CompressingSerializer(b"")),
+                                 ("dictionary", CompressingSerializer())]:
+            cache = SQLiteBackend(os.path.join(directory, f"{name}.sqlite"), autoclose=False, serializer=serializer)
+            size, latency = await measure(cache, responses)
+            await cache.close()
+            print(f"{name:>10}: {size / 1024:.1f} KB stored, {latency * 1000:.3f} ms per read")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
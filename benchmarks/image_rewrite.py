@@ -0,0 +1,42 @@
+# Compares the former per-image replace_img_name scans with the single pass replace_img_names on the
+# introduction of the Headshoots fixture. Run from the repository root: python -m benchmarks.image_rewrite
+import copy
+import timeit
+from importlib.resources import files
+
+import tests.resources as resources
+from lparchive2epub.lib import Extractor, get_cleaned_html, replace_img_names
+
+ROOT_URL = "https://lparchive.org/Dwarf-Fortress-Headshoots"
+RUNS = 50
+
+
+def per_image_scans(content, root_url, new_names):
+    # the former behaviour: every tag is visited once per image
+    for old_name, new_name in new_names.items():
+        for item in content.find_all("img"):
+            if Extractor.get_full_url(root_url, item["src"]) == old_name:
+                item["src"] = new_name
+        for item in content.find_all("a"):
+            if item.get("href", "") == old_name:
+                item["href"] = new_name
+    return content
+
+
+def main():
+    page = files(resources).joinpath("Dwarf Fortress - Headshoots.html").read_bytes()
+    intro = Extractor.intro(ROOT_URL, get_cleaned_html(page))
+    new_names = {x.url: f"images/{i}.{x.media_type}" for i, x in enumerate(intro.images)}
+    print(f"{len(new_names)} images, {len(intro.intro.find_all(['img', 'a']))} img and a tags")
+
+    expected = str(per_image_scans(copy.copy(intro.intro), ROOT_URL, new_names))
+    assert str(replace_img_names(copy.copy(intro.intro), ROOT_URL, new_names)) == expected
+
+    for name, f in [("per image", per_image_scans), ("single pass", replace_img_names)]:
+        trees = [copy.copy(intro.intro) for _ in range(RUNS)]
+        elapsed = timeit.timeit(lambda: f(trees.pop(), ROOT_URL, new_names), number=RUNS)
+        print(f"{name:>12}: {elapsed / RUNS * 1000:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,25 @@
+# Per page cost of get_cleaned_html with each installed parser backend on the fixture pages.
+# Run from the repository root: python -m benchmarks.parsers
+import timeit
+from importlib.resources import files
+
+import tests.resources as resources
+from lparchive2epub.lib import PARSERS, get_cleaned_html, resolve_parser
+
+PAGES = ["Resident Evil 1.html", "Dwarf Fortress - Headshoots.html", "X-COM_ Terror from the Deep.html"]
+RUNS = 20
+
+
+def main():
+    pages = {name: files(resources).joinpath(name).read_bytes() for name in PAGES}
+    for parser in PARSERS:
+        if resolve_parser(parser) != parser:
+            print(f"{parser:>12}: not installed")
+            continue
+        for name, page in pages.items():
+            elapsed = timeit.timeit(lambda: get_cleaned_html(page, parser), number=RUNS)
+            print(f"{parser:>12}: {elapsed / RUNS * 1000:6.2f} ms  {name} ({len(page) // 1024} KiB)")
+
+
+if __name__ == "__main__":
+    main()
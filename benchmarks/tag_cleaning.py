@@ -0,0 +1,41 @@
+# Compares the former find/unwrap loop of get_cleaned_html with the single traversal on a synthetic
+# Word-pasted update full of st1: and o:p tags. Run from the repository root: python -m benchmarks.tag_cleaning
+import timeit
+
+from bs4 import BeautifulSoup
+
+from lparchive2epub.lib import get_cleaned_html, tags_to_clean
+
+PARAGRAPHS = 400
+RUNS = 1
+
+
+def word_pasted_page(paragraphs: int) -> str:
+    body = "".join(
+        f"<p>We went to <st1:place><st1:city>Town {i}</st1:city>, <st1:state>State</st1:state></st1:place>"
+        f" then <st1:placename>Far</st1:placename> <st1:placetype>Lake</st1:placetype><o:p></o:p></p>\n"
+        for i in range(paragraphs)
+    )
+    return f'<html><head><title>Update</title></head><body><div id="content">{body}</div></body></html>'
+
+
+def find_unwrap_loop(page: str) -> BeautifulSoup:
+    # the former behaviour: every unwrap restarts the search from the top
+    xml_version = BeautifulSoup(page, "html.parser")
+    for tag in tags_to_clean:
+        while found := xml_version.find(tag):
+            found.unwrap()
+    return xml_version
+
+
+def main():
+    page = word_pasted_page(PARAGRAPHS)
+    print(f"{PARAGRAPHS * 6} tags to clean")
+    assert str(find_unwrap_loop(page)) == str(get_cleaned_html(page))
+    for name, f in [("find loop", find_unwrap_loop), ("one pass", get_cleaned_html)]:
+        elapsed = timeit.timeit(lambda: f(page), number=RUNS)
+        print(f"{name:>10}: {elapsed / RUNS * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
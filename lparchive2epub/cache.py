@@ -0,0 +1,179 @@
+import os
+import sys
+import time
+from datetime import datetime
+
+from aiohttp import ClientResponse
+from aiohttp_client_cache import CachedResponse, SQLiteBackend
+from aiohttp_client_cache.cache_control import CacheActions
+from yarl import URL
+
+from lparchive2epub.compression import CompressingSerializer
+
+DEFAULT_CACHE_MAX_SIZE = 1024 * 1024 * 1024
+CACHE_FILE_NAME = "http_cache.sqlite"
+
+# evict down to this fraction of the maximum size, so that eviction doesn't run on every save
+EVICTION_TARGET = 0.9
+
+
+def default_cache_dir() -> str:
+    if sys.platform == "win32":
+        base = os.environ.get("LOCALAPPDATA", os.path.expanduser("~"))
+    elif sys.platform == "darwin":
+        base = os.path.expanduser("~/Library/Caches")
+    else:
+        base = os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+    return os.path.join(base, "lparchive2epub")
+
+
+def is_landing_page(response: ClientResponse | CachedResponse) -> bool:
+    # the landing page lists the chapters, so it always comes from lparchive itself
+    url = URL(str(response.url))
+    return url.host == "lparchive.org" and len([x for x in url.path.split("/") if x]) == 1
+
+
+def is_page(url) -> bool:
+    # landing and update pages can be edited; images, wherever they are, never are in practice
+    url = URL(str(url))
+    return url.host == "lparchive.org" and "." not in url.path.rstrip("/").rsplit("/", 1)[-1]
+
+
+def has_validators(response: ClientResponse | CachedResponse) -> bool:
+    return "ETag" in response.headers or "Last-Modified" in response.headers
+
+
+def keep_unless_unvalidated_landing_page(response: ClientResponse | CachedResponse) -> bool:
+    # a landing page that can't be revalidated would hide new updates
+    return not is_landing_page(response) or has_validators(response)
+
+
+class PageRevalidation:
+    # Mixed into a cache backend: lparchive pages are kept with their ETag and Last-Modified, and every use sends
+    # If-None-Match / If-Modified-Since, so an unchanged page costs a 304 and an edited one is fetched again.
+    # Images stay cached with no expiry.
+
+    def __init__(self, *args, revalidate_pages: bool = True, **kwargs):
+        if revalidate_pages:
+            kwargs.setdefault("filter_fn", keep_unless_unvalidated_landing_page)
+        super().__init__(*args, **kwargs)
+        self.revalidate_pages = revalidate_pages
+
+    def create_cache_actions(self, key: str, url, *args, **kwargs) -> CacheActions:
+        actions = super().create_cache_actions(key, url, *args, **kwargs)
+        if self.revalidate_pages and is_page(url) and not actions.skip_read:
+            actions.revalidate = True
+        return actions
+
+
+class CompressedSQLiteBackend(SQLiteBackend):
+    # Pages are stored compressed, see CompressingSerializer; existing caches stay readable
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault("serializer", CompressingSerializer())
+        super().__init__(*args, **kwargs)
+
+
+class RevalidatingSQLiteBackend(PageRevalidation, CompressedSQLiteBackend):
+    pass
+
+
+class PersistentCache(PageRevalidation, CompressedSQLiteBackend):
+    # SQLite cache that survives runs, is capped at `max_size` bytes of stored responses by evicting the
+    # least recently used ones, and counts hits and misses. Pages are only revalidated when asked to.
+    # The lru sizes are the compressed ones.
+
+    def __init__(self, cache_dir: str | None = None, max_size: int = DEFAULT_CACHE_MAX_SIZE,
+                 revalidate_pages: bool = False, **kwargs):
+        cache_dir = cache_dir or default_cache_dir()
+        os.makedirs(cache_dir, exist_ok=True)
+        if not revalidate_pages:
+            kwargs.setdefault("filter_fn", lambda r: not is_landing_page(r))
+        super().__init__(os.path.join(cache_dir, CACHE_FILE_NAME), revalidate_pages=revalidate_pages, **kwargs)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self._size: int | None = None
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    async def _ensure_lru(self, db):
+        if self._size is not None:
+            return
+        await db.execute("CREATE TABLE IF NOT EXISTS lru (key PRIMARY KEY, size INTEGER, last_used REAL)")
+        # entries written before the lru table existed are treated as the oldest ones
+        await db.execute("INSERT OR IGNORE INTO lru SELECT key, length(value), 0 FROM responses")
+        cursor = await db.execute("SELECT COALESCE(SUM(size), 0) FROM lru")
+        self._size = (await cursor.fetchone())[0]
+
+    async def get_response(self, key: str):
+        response = await super().get_response(key)
+        if response is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        async with self.responses.get_connection(commit=True) as db:
+            await self._ensure_lru(db)
+            await db.execute("UPDATE lru SET last_used=? WHERE key=?", (time.time(), key))
+        return response
+
+    async def save_response(self, response: ClientResponse, cache_key: str | None = None,
+                            expires: datetime | None = None):
+        cache_key = cache_key or self.create_key(response.method, response.url)
+        await super().save_response(response, cache_key, expires)
+        async with self.responses.get_connection(commit=True) as db:
+            await self._ensure_lru(db)
+            cursor = await db.execute("SELECT size FROM lru WHERE key=?", (cache_key,))
+            previous = await cursor.fetchone()
+            cursor = await db.execute("SELECT length(value) FROM responses WHERE key=?", (cache_key,))
+            row = await cursor.fetchone()
+            size = row[0] if row else 0
+            await db.execute("INSERT OR REPLACE INTO lru (key, size, last_used) VALUES (?, ?, ?)",
+                             (cache_key, size, time.time()))
+            self._size += size - (previous[0] if previous else 0)
+        if self._size > self.max_size:
+            await self.evict()
+
+    async def delete(self, key: str):
+        await super().delete(key)
+        async with self.responses.get_connection(commit=True) as db:
+            await self._ensure_lru(db)
+            cursor = await db.execute("SELECT size FROM lru WHERE key=?", (key,))
+            row = await cursor.fetchone()
+            if row:
+                await db.execute("DELETE FROM lru WHERE key=?", (key,))
+                self._size -= row[0]
+
+    async def clear(self):
+        await super().clear()
+        async with self.responses.get_connection(commit=True) as db:
+            await db.execute("DROP TABLE IF EXISTS lru")
+        self._size = None
+
+    async def evict(self):
+        target = self.max_size * EVICTION_TARGET
+        # make sure the redirects table exists before deleting from it
+        async with self.redirects.get_connection():
+            pass
+        async with self.responses.get_connection(commit=True) as db:
+            await self._ensure_lru(db)
+            to_delete = []
+            async with db.execute("SELECT key, size FROM lru ORDER BY last_used") as cursor:
+                async for key, size in cursor:
+                    if self._size <= target:
+                        break
+                    to_delete.append(key)
+                    self._size -= size
+            for key in to_delete:
+                await db.execute("DELETE FROM responses WHERE key=?", (key,))
+                await db.execute("DELETE FROM redirects WHERE value=?", (key,))
+                await db.execute("DELETE FROM lru WHERE key=?", (key,))
+        self.evicted += len(to_delete)
+
+    def report(self) -> str:
+        return (f"cache: {self.hits} hits, {self.misses} misses ({self.hit_ratio:.0%} hit ratio), "
+                f"{self.evicted} evicted")
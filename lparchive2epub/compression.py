@@ -0,0 +1,71 @@
+import pickle
+import zlib
+from collections import Counter
+from hashlib import blake2b
+from importlib.resources import files
+from typing import Any, Iterable
+
+# Trained on lparchive pages by util/train_cache_dictionary.py. Entries record which dictionary they were
+# compressed with, so after retraining the old ones are read as cache misses rather than garbage.
+DICTIONARY_FILE = "lparchive.zdict"
+# deflate only looks back this far, a longer dictionary would not be used
+DICTIONARY_SIZE = 32 * 1024
+COMPRESSION_LEVEL = 6
+MAGIC = b"LP2Ez"
+# images and other binaries are compressed already
+COMPRESSED_TYPES = ("text/", "application/xhtml+xml", "application/json", "application/javascript")
+
+
+def load_dictionary() -> bytes:
+    return files("lparchive2epub").joinpath(DICTIONARY_FILE).read_bytes()
+
+
+def dictionary_id(dictionary: bytes) -> bytes:
+    return blake2b(dictionary, digest_size=4).digest()
+
+
+def train_dictionary(samples: Iterable[bytes], size: int = DICTIONARY_SIZE) -> bytes:
+    # lines shared by many pages (page skeleton, navigation, footer, recurring markup), most useful last since
+    # deflate reaches the end of the dictionary with the shortest distances
+    seen = Counter()
+    count = 0
+    for sample in samples:
+        count += 1
+        seen.update({line.strip() for line in sample.splitlines() if len(line.strip()) > 8})
+    shared = [(n * len(line), line) for line, n in seen.items() if n > 1 or count == 1]
+    shared.sort()
+    dictionary = b"\n".join(line for _, line in shared)
+    return dictionary[-size:]
+
+
+class CompressingSerializer:
+    # Pickles cached responses like aiohttp_client_cache does, and deflates the text ones against a shared
+    # dictionary; lparchive pages are mostly the same markup, which the dictionary covers even for the first
+    # bytes of a page. Plain pickles, like entries written before, are still read.
+
+    def __init__(self, dictionary: bytes | None = None, level: int = COMPRESSION_LEVEL):
+        self.dictionary = load_dictionary() if dictionary is None else dictionary
+        self.level = level
+        self.header = MAGIC + dictionary_id(self.dictionary)
+
+    @staticmethod
+    def compressible(item: Any) -> bool:
+        content_type = getattr(item, "content_type", None) or ""
+        return content_type.startswith(COMPRESSED_TYPES)
+
+    def dumps(self, item: Any) -> bytes:
+        data = pickle.dumps(item, protocol=pickle.HIGHEST_PROTOCOL)
+        if not self.compressible(item):
+            return data
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=self.dictionary)
+        return self.header + compressor.compress(data) + compressor.flush()
+
+    def loads(self, data: bytes) -> Any:
+        data = bytes(data)
+        if not data.startswith(MAGIC):
+            return pickle.loads(data)
+        if not data.startswith(self.header):
+            # compressed with another dictionary, the cache fetches it again
+            raise pickle.UnpicklingError("cache entry was compressed with another dictionary")
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS, zdict=self.dictionary)
+        return pickle.loads(decompressor.decompress(data[len(self.header):]) + decompressor.flush())
@@ -0,0 +1,49 @@
+import ssl
+
+import aiohttp
+from aiohttp_client_cache import CacheBackend, CachedSession
+
+from lparchive2epub.limiter import MAX_WINDOW, network_trace
+
+# The AIMD limiter decides how many requests are in flight, the pool only has to keep enough connections for it
+POOL_SIZE = 128
+POOL_SIZE_PER_HOST = int(MAX_WINDOW)
+# lparchive and its image hosts don't move, resolving them once in a while is plenty
+DNS_TTL = 600
+KEEPALIVE_TIMEOUT = 30.0
+
+
+class ConnectionPool:
+    # One connector (kept-alive connections, DNS cache and TLS context) for many conversions. Each conversion
+    # gets its own session on top of it, with its own cache, and closing that session leaves the pool alone.
+    # Must be entered in the event loop that uses it.
+
+    def __init__(self, limit: int = POOL_SIZE, limit_per_host: int = POOL_SIZE_PER_HOST, dns_ttl: int = DNS_TTL,
+                 keepalive_timeout: float = KEEPALIVE_TIMEOUT):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.dns_ttl = dns_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self.connector: aiohttp.TCPConnector | None = None
+
+    async def __aenter__(self):
+        # a single context, so certificates are loaded once for the whole run
+        self.connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host,
+                                              ttl_dns_cache=self.dns_ttl, keepalive_timeout=self.keepalive_timeout,
+                                              ssl=ssl.create_default_context())
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.connector.close()
+        self.connector = None
+
+    def session(self, cache: CacheBackend | None = None) -> aiohttp.ClientSession:
+        # `cache` is the namespace of one conversion, like the per let's play cache of a mirror
+        if self.connector is None:
+            raise RuntimeError("the connection pool is not open")
+        # traced, so that cache hits don't wait for the rate limit
+        if cache is None:
+            return aiohttp.ClientSession(connector=self.connector, connector_owner=False,
+                                         trace_configs=[network_trace()])
+        return CachedSession(cache=cache, connector=self.connector, connector_owner=False,
+                             trace_configs=[network_trace()])
@@ -0,0 +1,130 @@
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, Iterable, List
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    url TEXT PRIMARY KEY,
+    state TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    requeues INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    updated REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, lease_until);
+"""
+
+# How long a job stays with a worker that stopped heartbeating
+DEFAULT_LEASE = 300.0
+
+
+@dataclass
+class FailedJob:
+    url: str
+    worker: str
+    attempts: int
+    error: str
+
+
+class JobQueue:
+    # Durable work list in an SQLite file, shared by every worker process and every machine that can open it.
+    # Workers lease a job, heartbeat while they work on it and mark it done or failed; a lease that isn't
+    # renewed in time goes back to the other workers, so a crashed worker only loses its current job.
+
+    def __init__(self, path: str, lease: float = DEFAULT_LEASE):
+        self.path = path
+        self.lease_duration = lease
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self._db.executescript(SCHEMA)
+        columns = [x[1] for x in self._db.execute("PRAGMA table_info(jobs)")]
+        if "requeues" not in columns:
+            # job tables made before interruptions were counted
+            try:
+                self._db.execute("ALTER TABLE jobs ADD COLUMN requeues INTEGER NOT NULL DEFAULT 0")
+            except sqlite3.OperationalError:
+                # another worker added it first
+                pass
+
+    def add(self, urls: Iterable[str]) -> int:
+        # already known urls keep their state, so every node can add the same list
+        with self._lock:
+            now = time.time()
+            before = self._db.total_changes
+            self._db.execute("BEGIN IMMEDIATE")
+            self._db.executemany("INSERT OR IGNORE INTO jobs (url, updated) VALUES (?, ?)", ((x, now) for x in urls))
+            self._db.execute("COMMIT")
+            return self._db.total_changes - before
+
+    def lease(self, worker: str) -> str | None:
+        with self._lock:
+            now = time.time()
+            # the write lock is taken up front so two workers can't pick the same job
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._db.execute(
+                    "SELECT url FROM jobs WHERE state='pending' OR (state='leased' AND lease_until < ?) "
+                    "ORDER BY state DESC, rowid LIMIT 1", (now,)).fetchone()
+                if row is not None:
+                    self._db.execute("UPDATE jobs SET state='leased', worker=?, lease_until=?, attempts=attempts+1, "
+                                     "updated=? WHERE url=?", (worker, now + self.lease_duration, now, row[0]))
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            return row[0] if row else None
+
+    def heartbeat(self, url: str, worker: str) -> bool:
+        # False when the lease was lost, the job may be running somewhere else by now
+        with self._lock:
+            now = time.time()
+            cursor = self._db.execute("UPDATE jobs SET lease_until=?, updated=? "
+                                      "WHERE url=? AND worker=? AND state='leased'",
+                                      (now + self.lease_duration, now, url, worker))
+            return cursor.rowcount == 1
+
+    def done(self, url: str, worker: str):
+        with self._lock:
+            self._db.execute("UPDATE jobs SET state='done', error=NULL, lease_until=NULL, updated=? "
+                             "WHERE url=? AND worker=?", (time.time(), url, worker))
+
+    def fail(self, url: str, worker: str, error: str):
+        with self._lock:
+            self._db.execute("UPDATE jobs SET state='failed', error=?, lease_until=NULL, updated=? "
+                             "WHERE url=? AND worker=?", (error, time.time(), url, worker))
+
+    def release(self, url: str, worker: str):
+        # back to pending without counting as an attempt, for jobs interrupted by something else than themselves;
+        # how often that happened is kept in requeues
+        with self._lock:
+            self._db.execute("UPDATE jobs SET state='pending', worker=NULL, lease_until=NULL, attempts=attempts-1, "
+                             "requeues=requeues+1, updated=? WHERE url=? AND worker=? AND state='leased'",
+                             (time.time(), url, worker))
+
+    def requeues(self, url: str) -> int:
+        with self._lock:
+            row = self._db.execute("SELECT requeues FROM jobs WHERE url=?", (url,)).fetchone()
+            return row[0] if row else 0
+
+    def retry_failed(self) -> int:
+        with self._lock:
+            cursor = self._db.execute("UPDATE jobs SET state='pending', worker=NULL, requeues=0, updated=? "
+                                      "WHERE state='failed'", (time.time(),))
+            return cursor.rowcount
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._db.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+
+    def failures(self) -> List[FailedJob]:
+        with self._lock:
+            return [FailedJob(*x) for x in self._db.execute(
+                "SELECT url, worker, attempts, error FROM jobs WHERE state='failed' ORDER BY url").fetchall()]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
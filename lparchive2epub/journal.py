@@ -0,0 +1,129 @@
+import io
+import os
+import sqlite3
+import threading
+from dataclasses import dataclass
+from typing import BinaryIO, List
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS chapters (num INTEGER PRIMARY KEY, href TEXT, title TEXT, content TEXT);
+CREATE TABLE IF NOT EXISTS chapter_images (
+    chapter INTEGER, position INTEGER, num INTEGER, hash TEXT, old_name TEXT, new_name TEXT, root_url TEXT,
+    PRIMARY KEY (chapter, position)
+);
+CREATE TABLE IF NOT EXISTS images (hash TEXT PRIMARY KEY, media_type TEXT, data BLOB);
+"""
+
+
+def journal_path(file: str) -> str:
+    return f"{file}.journal"
+
+
+class JournaledImage:
+    # Same reading interface as a SpooledImage, backed by anything with an image_data(digest) method
+
+    def __init__(self, journal, digest: str, size: int):
+        self.journal = journal
+        self.hash = digest
+        self.size = size
+
+    def open(self) -> BinaryIO:
+        return io.BytesIO(self.read())
+
+    def read(self) -> bytes:
+        return self.journal.image_data(self.hash)
+
+    def release(self):
+        pass
+
+
+@dataclass
+class JournaledImageRef:
+    num: int
+    hash: str
+    old_name: str
+    new_name: str
+    root_url: str
+    media_type: str
+    source: JournaledImage
+
+
+@dataclass
+class JournaledChapter:
+    num: int
+    title: str
+    content: str
+    images: List[JournaledImageRef]
+
+
+class Journal:
+    # Checkpoints every finished chapter (xhtml and images) of a conversion in an SQLite file next to the
+    # output, so a run that fails late can skip the chapters it already had. Deleted once the book is written.
+
+    def __init__(self, path: str, url: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(SCHEMA)
+        row = self._db.execute("SELECT value FROM meta WHERE key='url'").fetchone()
+        if row is None or row[0] != url:
+            # a journal for another let's play is of no use
+            self._db.executescript("DELETE FROM chapters; DELETE FROM chapter_images; DELETE FROM images;")
+            self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('url', ?)", (url,))
+        self._db.commit()
+
+    def completed(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM chapters").fetchone()[0]
+
+    def record(self, num: int, href: str, title: str, content: str, images: list):
+        # images are IndexedEpubImage; bytes are only stored once per hash
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO chapters (num, href, title, content) VALUES (?, ?, ?, ?)",
+                             (num, href, title, content))
+            self._db.execute("DELETE FROM chapter_images WHERE chapter=?", (num,))
+            for position, img in enumerate(images):
+                self._db.execute("INSERT INTO chapter_images VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                 (num, position, img.num, img.hash, img.old_name, img.new_name, img.root_url))
+            self._store_images(images)
+
+    def store_images(self, images: list):
+        # for images shared with pages that are not journaled, like the introduction
+        with self._lock, self._db:
+            self._store_images(images)
+
+    def _store_images(self, images: list):
+        for img in images:
+            known = self._db.execute("SELECT 1 FROM images WHERE hash=?", (img.hash,)).fetchone()
+            if not known:
+                self._db.execute("INSERT INTO images (hash, media_type, data) VALUES (?, ?, ?)",
+                                 (img.hash, img.data.media_type, img.data.source.read()))
+
+    def load(self, num: int, href: str, title: str) -> JournaledChapter | None:
+        with self._lock:
+            row = self._db.execute("SELECT href, title, content FROM chapters WHERE num=?", (num,)).fetchone()
+            if row is None or row[0] != href or row[1] != title:
+                return None
+            images = self._db.execute(
+                "SELECT c.num, c.hash, c.old_name, c.new_name, c.root_url, i.media_type, length(i.data) "
+                "FROM chapter_images c JOIN images i ON i.hash = c.hash WHERE c.chapter=? ORDER BY c.position",
+                (num,)).fetchall()
+        return JournaledChapter(num=num, title=title, content=row[2], images=[
+            JournaledImageRef(num=i[0], hash=i[1], old_name=i[2], new_name=i[3], root_url=i[4], media_type=i[5],
+                              source=JournaledImage(self, i[1], i[6]))
+            for i in images
+        ])
+
+    def image_data(self, digest: str) -> bytes:
+        with self._lock:
+            return self._db.execute("SELECT data FROM images WHERE hash=?", (digest,)).fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def discard(self):
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
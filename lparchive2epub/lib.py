@@ -1,31 +1,49 @@
 import asyncio
 import datetime
 import functools
+import html
+import itertools
+import json
+import multiprocessing
 import os
 import re
+import time
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
 from hashlib import blake2b
-from typing import List, Tuple
+from typing import Dict, List, Tuple
 from urllib.parse import urlparse, urlunparse, unquote
 
 import aiohttp
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
+from bs4.builder import builder_registry
 from ebooklib import epub
-from ebooklib.epub import EpubHtml, EpubImage, EpubBook
+from ebooklib.epub import EpubHtml, EpubBook
 from tqdm.asyncio import tqdm
 
+from lparchive2epub.journal import Journal, JournaledImageRef, journal_path
+from lparchive2epub.limiter import PerHostLimiter, format_metrics, network_trace
+from lparchive2epub.previous import MANIFEST_NAME, PreviousBook
+from lparchive2epub.retry import HttpStatusError, RetryPolicy, parse_retry_after
+from lparchive2epub.shrink import ImageShrinker, ShrinkCache, ShrinkOptions, pillow_available
+from lparchive2epub.spool import CHUNK_SIZE, DEFAULT_MEMORY_BUDGET, ImageSpool, SpooledImage
+from lparchive2epub.store import ImageStore, StoredImage
 from lparchive2epub.style import get_style_item
+from lparchive2epub.writer import PrebuiltEpubHtml, ReorderBuffer, SpooledEpubImage, StreamingEpubWriter
 
-# Concurrency limit for worker queues
+# Upper bounds for worker queues; the per-host AIMD limiter decides how many requests are actually in flight.
+# Image workers are shared by the whole run, so at most CONCURRENCY_LIMIT_PAGES + CONCURRENCY_LIMIT_IMAGES
+# requests are ever open at once.
 CONCURRENCY_LIMIT_PAGES = 25
 CONCURRENCY_LIMIT_IMAGES = 10
+IMAGE_QUEUE_SIZE = 200
 
 def get_blake2b_hash(content: bytes) -> str:
     hasher = blake2b()
     hasher.update(content)
     return hasher.hexdigest()
 
-@dataclass(order=True)
+@dataclass(order=True, slots=True)
 class Chapters:
     num: int
     original_href: str
@@ -36,34 +54,24 @@ class Chapters:
     def __hash__(self):
         return hash((self.original_href, str(self.txt.text)))
 
-    def __post_init__(self):
-        self.sort_index = self.num
 
-
-@dataclass(order=True)
+@dataclass(order=True, slots=True)
 class Image:
     num: int
     src: str
     media_type: str
-    tag: BeautifulSoup
     url: str
     root_url: str
 
-    def __post_init__(self):
-        self.sort_index = self.num
-
 
-@dataclass(order=True)
+@dataclass(order=True, slots=True)
 class IndexedEpubImage:
     num: int
     hash: str
     old_name: str
     new_name: str
     root_url: str
-    data: EpubImage
-
-    def __post_init__(self):
-        self.sort_index = self.num
+    data: SpooledEpubImage
 
 
 @dataclass
@@ -71,9 +79,11 @@ class Intro:
     title: str
     language: str
     author: str
-    intro: BeautifulSoup
+    # dropped once the introduction page is built, it keeps the whole landing page tree alive
+    intro: BeautifulSoup | None
     images: List[Image]
     chapters: List[Chapters]
+    chapter_index: "ChapterIndex"
     published_on: str
 
 
@@ -93,30 +103,40 @@ FIND_FILES = re.compile(r"([.])[^/.]+$")
 FIND_ANCHOR_LINKS = re.compile(r"(#)[^/.]+$")
 
 
+class ChapterIndex:
+    # All chapter slugs of a let's play in one matcher, built once from the landing page, so a page's links
+    # are rewritten in a single pass. Longer slugs win, so "Update%201" never eats into "Update%2010".
+
+    def __init__(self, chapters: List[Chapters]):
+        self.chapters = chapters
+        self.by_slug: Dict[str, Chapters] = {}
+        for c in chapters:
+            self.by_slug.setdefault(c.original_href_slug, c)
+        slugs = sorted(self.by_slug, key=len, reverse=True)
+        self.pattern = re.compile("|".join(re.escape(x) for x in slugs)) if slugs else None
+
+    def rewrite(self, href: str) -> str:
+        # links to chapters now point inside the book, links to their assets to lparchive
+        if self.pattern is None:
+            return href
+        if FIND_FILES.search(href):
+            return self.pattern.sub(lambda m: self.by_slug[m.group(0)].original_href + "/", href)
+        return self.pattern.sub(lambda m: self.by_slug[m.group(0)].new_href + "/", href)
+
+
 class Extractor:
 
     @staticmethod
-    def fix_links(content, chapters, current_url: str):
+    def fix_links(content, chapters: "ChapterIndex", current_url: str):
         if not current_url.endswith("/"):
             current_url += "/"
 
-        all_links = [x for x in content.find_all("a") if x.get("href", None)]
-        for link in all_links:
-            link["href"] = link["href"].replace("../", "")
-
-        local_assets = (x for x in all_links if FIND_FILES.search(x.get("href")) and "/" not in x.get("href"))
-
-        for link_to_asset in local_assets:
-            link_to_asset["href"] = current_url + link_to_asset["href"]
-
-        for c in chapters:
-            links = content.find_all("a", href=re.compile(c.original_href_slug))
-            to_update = (x for x in links if not FIND_FILES.search(x.get("href")))
-            for link_to_update in to_update:
-                link_to_update["href"] = link_to_update["href"].replace(c.original_href_slug, c.new_href + "/")
-            asset_links = (x for x in links if FIND_FILES.search(x.get("href")))
-            for link_to_asset in asset_links:
-                link_to_asset["href"] = link_to_asset["href"].replace(c.original_href_slug, c.original_href + "/")
+        for link in content.find_all("a", href=True):
+            href = link["href"].replace("../", "")
+            if FIND_FILES.search(href) and "/" not in href:
+                # local asset
+                href = current_url + href
+            link["href"] = chapters.rewrite(href)
 
     @staticmethod
     def get_known_update_names(url: str) -> List[str]:
@@ -127,21 +147,26 @@ class Extractor:
         return knownUpdateNames
 
     @staticmethod
-    def intro(url: str, p: BeautifulSoup) -> Intro:
-        title = p.title.text
-        author = next(x for x in p.find_all("meta") if x.get("name", None) == "author").get("content", None)
+    def intro(url: str, p: BeautifulSoup, metadata: BeautifulSoup | None = None) -> Intro:
+        # metadata holds the title, meta and archival tags when p was restricted to the content
+        if metadata is None:
+            metadata = p
+        title = metadata.title.text
+        author = next(x for x in metadata.find_all("meta") if x.get("name", None) == "author").get("content", None)
         language = "en"
         content = p.find("div", id="content")
         chapters = Extractor.all_chapters(url, p)
-        Extractor.fix_links(content, chapters, url)
+        chapter_index = ChapterIndex(chapters)
+        Extractor.fix_links(content, chapter_index, url)
 
         images = Extractor.all_images(content, url)
 
-        archival = p.find("li", id="archival")
+        archival = metadata.find("li", id="archival")
         published_on = archival.find("strong").text
 
         return Intro(
-            title=title, language=language, author=author, intro=content, images=images, chapters=chapters, published_on=published_on
+            title=title, language=language, author=author, intro=content, images=images, chapters=chapters,
+            chapter_index=chapter_index, published_on=published_on
         )
 
     @staticmethod
@@ -227,7 +252,6 @@ class Extractor:
                 num=i,
                 src=x['src'],
                 media_type=get_media_type(x["src"][-3:]),
-                tag=x,
                 url=Extractor.get_full_url(root_url, x["src"]),
                 root_url=root_url
             ))
@@ -242,7 +266,6 @@ class Extractor:
                 num=i,
                 src=link['href'],
                 media_type=get_media_type(link['href'][-3:]),
-                tag=link,  # Use the link tag itself
                 url=Extractor.get_full_url(root_url, link['href']),
                 root_url=root_url
             ))
@@ -250,22 +273,19 @@ class Extractor:
         return r
 
     @staticmethod
-    def get_update(chapters: List[Chapters], p: BeautifulSoup, chapter: Chapters) -> Update:
+    def get_update(chapters: "ChapterIndex", p: BeautifulSoup, chapter: Chapters) -> Update:
         content = p.find("div", id="content")
         images = Extractor.all_images(content, chapter.original_href)
         Extractor.fix_links(content, chapters, chapter.original_href)
         return Update(content=content, images=images)
 
 
-@dataclass(order=True)
+@dataclass(order=True, slots=True)
 class Page:
     num: int
     chapter: EpubHtml
     images: List[IndexedEpubImage]
 
-    def __post_init__(self):
-        self.sort_index = self.num
-
 async def _default_get(r):
     return await r.text()
 
@@ -275,264 +295,491 @@ CURL_HEADERS = {
     "accept": "*/*"
 }
 
-async def get_resource_with_retries(session: aiohttp.ClientSession, url, action=_default_get, max_retries=5):
-    retry_count = 0
-    last_exception = None
-
-    while retry_count < max_retries:
+async def get_resource_with_retries(session: aiohttp.ClientSession, url, action=_default_get,
+                                    limiter: PerHostLimiter | None = None, retry: RetryPolicy | None = None):
+    if limiter is None:
+        limiter = PerHostLimiter()
+    if retry is None:
+        retry = RetryPolicy()
+    deadline = time.monotonic() + retry.deadline
+    attempt = 0
+
+    while True:
+        attempt += 1
+        waiting = time.monotonic()
+        slot = None
         try:
-            async with session.get(url, headers=CURL_HEADERS) as r:
-                if r.status != 200:
-                    raise RuntimeError(f"Failed to get resource {url}, status code: {r.status}")
-                return await action(r)
+            async with limiter.slot(url) as slot:
+                # waiting for the breaker or room in the window would otherwise eat into the deadline and time
+                # requests out before they are sent, probes included
+                deadline += time.monotonic() - waiting
+                async with asyncio.timeout(min(retry.attempt_timeout, deadline - time.monotonic())) as slot.timeout:
+                    # the rate limit is waited for once the request goes to the network, and pushes both back
+                    async with session.get(url, headers=CURL_HEADERS, trace_request_ctx=slot) as r:
+                        slot.status = r.status
+                        slot.from_cache = getattr(r, "from_cache", False)
+                        if r.status != 200:
+                            raise HttpStatusError(url, r.status, parse_retry_after(r.headers.get("Retry-After")))
+                        result = await action(r)
+            retry.budget.earn(url)
+            return result
         except Exception as e:
-            last_exception = e
-            retry_count += 1
-            if retry_count < max_retries:
-                # Exponential backoff: 2^retry_count * 1s (2s, 4s, 8s, 16s)
-                wait_time = (2 ** retry_count) * 1
-                await asyncio.sleep(wait_time)
-    raise RuntimeError(f"Failed to get resource {url} after {max_retries} retries: {last_exception}")
-
-
-
-async def _get_image(session: aiohttp.ClientSession, img: Image, registry: dict = None) -> IndexedEpubImage:
+            deadline += slot.waited if slot is not None else 0.0
+            delay = retry.delay(attempt, e)
+            if delay is None:
+                raise
+            if attempt >= retry.attempts or time.monotonic() + delay >= deadline:
+                raise RuntimeError(f"Failed to get resource {url} after {attempt} attempts: {e}") from e
+            if not retry.budget.spend(url):
+                raise RuntimeError(f"Failed to get resource {url}, giving up on {urlparse(url).netloc} "
+                                   f"after too many failures: {e}") from e
+            await asyncio.sleep(delay)
+
+
+def _indexed_image(img: Image, digest: str, source: SpooledImage | StoredImage) -> IndexedEpubImage:
+    media_type = img.media_type
+    new_name = f"images/{digest}.{media_type}"
+    return IndexedEpubImage(
+        img.num,
+        digest,
+        img.url,  # Use the original URL as old_name
+        new_name,
+        img.root_url,
+        SpooledEpubImage(
+            uid=f"i{digest}",
+            file_name=new_name,
+            media_type=f"image/{media_type}",
+            source=source)
+    )
+
+
+async def _finish_image(img: Image, source: SpooledImage | StoredImage,
+                        shrinker: ImageShrinker | None = None) -> IndexedEpubImage:
+    if shrinker is None:
+        return _indexed_image(img, source.hash, source)
+    # named after the original, whatever the shrinking turned it into
+    return _indexed_image(img, source.hash, await shrinker.shrink(source))
+
+
+async def _get_image(session: aiohttp.ClientSession, img: Image, limiter: PerHostLimiter | None = None,
+                     spool: ImageSpool | None = None, store: ImageStore | None = None,
+                     shrinker: ImageShrinker | None = None, retry: RetryPolicy | None = None) -> IndexedEpubImage:
     # Get the image URL from either src (for img tags) or href (for a tags)
     img_url = img.url
+    if spool is None:
+        spool = ImageSpool()
 
-    if registry is not None:
-        if img_url in registry:
-            return await registry[img_url]
-        loop = asyncio.get_running_loop()
-        future = loop.create_future()
-        registry[img_url] = future
-    else:
-        future = None
+    if store is not None:
+        stored = await asyncio.to_thread(store.lookup, img_url)
+        if stored is not None:
+            return await _finish_image(img, stored, shrinker)
 
     async def get(r):
-        media_type = img.media_type
-        content = await r.content.read()
-        img_hash = get_blake2b_hash(content)
-        new_name = f"images/{img_hash}.{media_type}"
-        return IndexedEpubImage(
-            img.num,
-            img_hash,
-            img_url,  # Use the original URL as old_name
-            new_name,
-            img.root_url,
-            EpubImage(
-                uid=f"i{img_hash}",
-                file_name=new_name,
-                media_type=f"image/{media_type}",
-                content=content)
-        )
+        # hashed chunk by chunk while it is spooled, the bytes are only read back when the zip entry is written
+        return await spool.store(r.content.iter_chunked(CHUNK_SIZE))
+
+    spooled = await get_resource_with_retries(session, img_url, get, limiter=limiter, retry=retry)
+    if store is None:
+        return await _finish_image(img, spooled, shrinker)
+    # the store keeps the bytes from now on
+    stored = await asyncio.to_thread(store.put, img_url, spooled)
+    spooled.release()
+    return await _finish_image(img, stored, shrinker)
+
+
+class ImageScheduler:
+    # One bounded, chapter-prioritised image queue for the whole run, shared by the intro and every update.
+    # Images already requested (by url) are awaited through the registry instead of being fetched again.
+    # Images that couldn't be fetched are kept in `failed` with their error, to be reported with the book.
+
+    def __init__(self, session: aiohttp.ClientSession, limiter: PerHostLimiter | None = None,
+                 workers: int = CONCURRENCY_LIMIT_IMAGES, queue_size: int = IMAGE_QUEUE_SIZE,
+                 spool: ImageSpool | None = None, store: ImageStore | None = None,
+                 shrinker: ImageShrinker | None = None, retry: RetryPolicy | None = None):
+        self.session = session
+        self.limiter = limiter
+        self.spool = spool
+        self.store = store
+        self.shrinker = shrinker
+        self.retry = retry
+        self.registry: dict[str, asyncio.Future] = {}
+        self.failed: dict[str, Exception] = {}
+        self.workers = workers
+        self._queue: asyncio.PriorityQueue = asyncio.PriorityQueue(maxsize=queue_size)
+        self._order = itertools.count()
+        self._tasks: list[asyncio.Task] = []
+
+    async def __aenter__(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        return self
+
+    async def __aexit__(self, *exc):
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        for future in self.registry.values():
+            if not future.done():
+                future.cancel()
+
+    async def _worker(self):
+        while True:
+            _, _, img, future = await self._queue.get()
+            try:
+                res = await _get_image(self.session, img, self.limiter, self.spool, self.store, self.shrinker,
+                                       self.retry)
+            except Exception as e:
+                del self.registry[img.url]
+                self.failed[img.url] = e
+                future.set_exception(e)
+            else:
+                self.failed.pop(img.url, None)
+                future.set_result(res)
+            finally:
+                self._queue.task_done()
+
+    async def get(self, img: Image, priority: int = 0) -> IndexedEpubImage:
+        future = self.registry.get(img.url)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self.registry[img.url] = future
+            await self._queue.put((priority, next(self._order), img, future))
+        # shielded: the future is shared with every other page using the same image
+        return await asyncio.shield(future)
+
+    async def get_all(self, wanted: List[Image], priority: int = 0) -> List[IndexedEpubImage]:
+        # a dead image doesn't take its page down, it is left out and the page keeps pointing to its url
+        results = await asyncio.gather(*(self.get(x, priority) for x in wanted), return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException) and not isinstance(result, Exception):
+                raise result
+        return [x for x in results if not isinstance(x, BaseException)]
 
-    try:
-        res = await get_resource_with_retries(session, img_url, get)
-        if future:
-            future.set_result(res)
-        return res
-    except Exception as e:
-        if future:
-            future.set_exception(e)
-            del registry[img_url]
-        raise
 
-async def build_intro(session: aiohttp.ClientSession, url_root: str, intro: Intro, registry: dict = None) -> Page:
-    intro_chapter = epub.EpubHtml(title="Introduction", file_name="introduction.xhtml", lang=intro.language)
-    intro_chapter.add_item(get_style_item())
-    tasks = []
-    for image in intro.images:
-        task = asyncio.ensure_future(_get_image(session, image, registry))
-        tasks.append(task)
+tags_to_clean = [
+    "st1:place",
+    "st1:city",
+    "st1:country-region",
+    "st1:placename",
+    "st1:placetype",
+    "st1:state",
+    "o:p"
+]
 
-    images = await asyncio.gather(*tasks)
 
-    for image in images:
-        intro.intro = replace_img_name(intro.intro, image)
+# html.parser is always there and is what the published checksums were made with;
+# lxml parses faster, "auto" picks it when installed
+DEFAULT_PARSER = "html.parser"
+PARSERS = ["html.parser", "lxml", "html5lib"]
+AUTO_PARSERS = ["lxml", "html.parser"]
 
-    intro_chapter.content = str(intro.intro)
 
-    return Page(0, intro_chapter, images)
+def resolve_parser(name: str = DEFAULT_PARSER) -> str:
+    # falls back to html.parser when the requested backend isn't installed
+    candidates = AUTO_PARSERS if name == "auto" else [name]
+    return next((x for x in candidates if builder_registry.lookup(x) is not None), DEFAULT_PARSER)
 
 
-def replace_img_name(content: BeautifulSoup, image: IndexedEpubImage) -> BeautifulSoup:
-    # Handle img tags
-    to_change_imgs = (x for x in content.find_all("img") if Extractor.get_full_url(image.root_url, x["src"]) == image.old_name)
-    for item in to_change_imgs:
-        item["src"] = image.new_name
+# Only the content of a page is ever used, the rest of it isn't worth a tree
+CONTENT_ONLY = SoupStrainer("div", id="content")
 
-    # Handle linked images
-    to_change_links = (x for x in content.find_all("a") if x.get("href", "") == image.old_name)
-    for item in to_change_links:
-        item["href"] = image.new_name
 
-    return content
+def is_landing_metadata(name: str, attrs) -> bool:
+    # what Extractor.intro reads from a landing page; every <li> would keep all of its lists
+    attrs = attrs or {}
+    return (name == "title" or (name == "meta" and attrs.get("name") == "author")
+            or (name == "li" and attrs.get("id") == "archival"))
 
-def batch(iterable, n=1):
-    l = len(iterable)
-    for ndx in range(0, l, n):
-        yield iterable[ndx:min(ndx + n, l)]
 
-async def build_update(session: aiohttp.ClientSession, chapter: Chapters, data: Update, intro: Intro, registry: dict = None) -> Page:
-    update_chapter = epub.EpubHtml(title=str(chapter.txt), file_name=chapter.new_href,
-                                   lang=intro.language)  # TODO: fix language
-    update_chapter.add_item(get_style_item())
+class LandingMetadataStrainer(SoupStrainer):
+    # beautifulsoup4 before 4.13 calls the name function with the attributes, later ones ask allow_tag_creation
 
-    img_builder = functools.partial(_get_image, session, registry=registry)
+    def __init__(self):
+        super().__init__(is_landing_metadata)
 
-    # Queue-based worker pool to cap concurrency
-    q: asyncio.Queue = asyncio.Queue()
-    images: list[IndexedEpubImage] = []
+    def allow_tag_creation(self, nsprefix, name, attrs) -> bool:
+        return is_landing_metadata(name, attrs)
 
-    async def worker():
-        while True:
-            try:
-                img = await q.get()
-                try:
-                    res = await img_builder(img)
-                    replace_img_name(data.content, res)
-                    images.append(res)
-                finally:
-                    q.task_done()
-            except asyncio.CancelledError:
-                break
 
-    workers = [asyncio.create_task(worker()) for _ in range(CONCURRENCY_LIMIT_IMAGES)]
+LANDING_METADATA = LandingMetadataStrainer()
 
-    # Enqueue images with their indices
-    for image in data.images:
-        await q.put(image)
 
-    # Wait for completion and shutdown workers
-    await q.join()
-    for w in workers:
-        w.cancel()
+def get_cleaned_html(page: str, parser: str = DEFAULT_PARSER, parse_only: SoupStrainer | None = None) -> BeautifulSoup:
+    xml_version = BeautifulSoup(page, parser, parse_only=parse_only)
+    # collected in one traversal; unwrapping keeps the nested ones in the tree
+    for found in xml_version.find_all(tags_to_clean):
+        found.unwrap()
+    return xml_version
 
-    await asyncio.gather(*workers, return_exceptions=True)
 
-    update_chapter.content = str(data.content)
+# Image references are left as placeholders by the transform stage and filled in once the images are fetched
+IMAGE_PLACEHOLDER = "lparchive2epub-image:{}"
+FIND_IMAGE_PLACEHOLDERS = re.compile(r'"lparchive2epub-image:(\d+)"')
 
-    return Page(chapter.num, update_chapter, images)
 
+@dataclass(slots=True)
+class TransformedUpdate:
+    xhtml: str
+    images: List[Image]
+    urls: List[str]
 
-def add_page(known_images: dict, book: EpubBook, toc: List, spine: List, page: Page):
-    book.add_item(page.chapter)
-    for img in page.images:
-        if img.hash not in known_images["hashes"]:
-            book.add_item(img.data)
-            known_images["hashes"].append(img.hash)
-    toc.append(epub.Link(page.chapter.file_name, page.chapter.title, page.chapter.id))
-    spine.append(page.chapter)
 
+def transform(chapters: ChapterIndex, page_text: str, num: int, parser: str = DEFAULT_PARSER) -> TransformedUpdate:
+    chapter = chapters.chapters[num]
+    update = Extractor.get_update(chapters, get_cleaned_html(page_text, parser, CONTENT_ONLY), chapter)
+    urls = list(dict.fromkeys(x.url for x in update.images))
+    replace_img_names(update.content, chapter.original_href,
+                      {url: IMAGE_PLACEHOLDER.format(i) for i, url in enumerate(urls)})
+    return TransformedUpdate(xhtml=str(update.content), images=update.images, urls=urls)
 
-async def build_single_page(session: aiohttp.ClientSession, intro: Intro, chapter: Chapters, all_chapters: List[Chapters], pbar, registry: dict = None) -> Page:
-    async def get(r):
-        chapter_bs = get_cleaned_html(await r.text())
-        update = Extractor.get_update(all_chapters, chapter_bs, chapter)
-        u = await build_update(session, chapter, update, intro, registry)
-        pbar.update(1)
-        return u
 
-    return await get_resource_with_retries(session, chapter.original_href, get)
+def place_images(data: TransformedUpdate, fetched: List[IndexedEpubImage]) -> str:
+    # images that couldn't be fetched keep their original url
+    new_names = {x.old_name: x.new_name for x in fetched}
 
-async def lparchive2epub(url: str, file: str, root_session: aiohttp.ClientSession | None = None, writer=tqdm.write):
-    if url.endswith("/"):
-        url = url[:-1]
-    if root_session is None:
-        root_session = aiohttp.ClientSession()
-    async with root_session as session:
-        await do(url, file, session, writer)
+    def placed(m: re.Match) -> str:
+        url = data.urls[int(m.group(1))]
+        return f'"{html.escape(new_names.get(url, url))}"'
 
+    return FIND_IMAGE_PLACEHOLDERS.sub(placed, data.xhtml)
 
-tags_to_clean = [
-    "st1:place",
-    "st1:city",
-    "st1:country-region",
-    "st1:placename",
-    "st1:placetype",
-    "st1:state",
-    "o:p"
-]
 
+_pool_chapters: ChapterIndex | None = None
+_pool_parser = DEFAULT_PARSER
 
-def get_cleaned_html(page: str) -> BeautifulSoup:
-    xml_version = BeautifulSoup(page, "html.parser")
-    for tag in tags_to_clean:
-        while found := xml_version.find(tag):
-            found.unwrap()
-    return xml_version
 
+def _init_transform_worker(chapters: ChapterIndex, parser: str):
+    global _pool_chapters, _pool_parser
+    _pool_chapters = chapters
+    _pool_parser = parser
 
-async def do(url: str, file: str, session: aiohttp.ClientSession, writer):
-    writer(f"extracting lp from {url}")
-    writer("getting landing page")
-    page_text = await get_resource_with_retries(session, url)
 
-    landing = get_cleaned_html(page_text)
+def _transform_in_worker(page_text: str, num: int) -> TransformedUpdate:
+    return transform(_pool_chapters, page_text, num, _pool_parser)
 
-    book = epub.EpubBook()
-    intro = Extractor.intro(url, landing)
 
-    toc = []
-    spine = ["nav"]
+class Transformer:
+    # Parses, cleans and rewrites update pages in a process pool so the event loop keeps downloading meanwhile.
+    # The chapter list is sent once to each worker; with workers=0 pages are transformed inline.
 
-    writer("building intro")
-    image_registry = {}
-    epub_intro = await build_intro(session, url, intro, image_registry)
+    def __init__(self, chapters: ChapterIndex, workers: int | None = None, parser: str = DEFAULT_PARSER):
+        self.chapters = chapters
+        self.parser = parser
+        self.workers = (os.cpu_count() or 1) if workers is None else workers
+        self._pool: ProcessPoolExecutor | None = None
+
+    async def __aenter__(self):
+        if self.workers:
+            # forking a process running aiohttp and sqlite threads isn't safe
+            self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"),
+                                             initializer=_init_transform_worker, initargs=(self.chapters, self.parser))
+        return self
+
+    async def __aexit__(self, *exc):
+        if self._pool:
+            await asyncio.to_thread(self._pool.shutdown, cancel_futures=True)
+            self._pool = None
+
+    async def transform(self, page_text: str, num: int) -> TransformedUpdate:
+        if self._pool is None:
+            return transform(self.chapters, page_text, num, self.parser)
+        return await asyncio.get_running_loop().run_in_executor(self._pool, _transform_in_worker, page_text, num)
+
+    async def run(self, fn, *args):
+        # the other cpu bound work of a conversion, like shrinking images, uses the same processes
+        if self._pool is None:
+            return fn(*args)
+        return await asyncio.get_running_loop().run_in_executor(self._pool, fn, *args)
 
-    known_images = {
-        "hashes": [],
-    }
 
-    add_page(known_images, book, toc, spine, epub_intro)
+async def build_intro(images: ImageScheduler, url_root: str, intro: Intro) -> Page:
+    intro_chapter = epub.EpubHtml(title="Introduction", file_name="introduction.xhtml", lang=intro.language)
+    intro_chapter.add_item(get_style_item())
 
-    # pages takes a vastly inequal times to get, so it's faster to gather and sort
-    # gotta go fast, but also keep the page order.
+    fetched = await images.get_all(intro.images, 0)
 
-    writer("building chapters / updates")
+    # images that couldn't be fetched point to their original url
+    new_names = {x.url: x.url for x in intro.images}
+    new_names.update({x.old_name: x.new_name for x in fetched})
+    replace_img_names(intro.intro, url_root, new_names)
 
-    pages_indexed: list[tuple[int, Page]] = []
+    intro_chapter.content = str(intro.intro)
 
-    with tqdm(total=len(intro.chapters), desc="Gathering and building pages") as pbar:
-        q: asyncio.Queue = asyncio.Queue()
+    return Page(0, intro_chapter, fetched)
 
-        async def worker():
-            while True:
-                try:
-                    i, chapter = await q.get()
-                    try:
-                        page = await build_single_page(session, intro, chapter, intro.chapters, pbar, image_registry)
-                        pages_indexed.append((i, page))
-                    finally:
-                        q.task_done()
-                except asyncio.CancelledError:
-                    break
 
-        workers = [asyncio.create_task(worker()) for _ in range(CONCURRENCY_LIMIT_PAGES)]
+def replace_img_names(content: BeautifulSoup, root_url: str, new_names: Dict[str, str]) -> BeautifulSoup:
+    # new_names maps the full url of each image to its new name; a single pass over the tree
+    for item in content.find_all(["img", "a"]):
+        if item.name == "img":
+            if item.get("src") is not None:
+                new_name = new_names.get(Extractor.get_full_url(root_url, item["src"]))
+                if new_name is not None:
+                    item["src"] = new_name
+        else:
+            # linked images
+            new_name = new_names.get(item.get("href", ""))
+            if new_name is not None:
+                item["href"] = new_name
+    return content
 
-        for i, chapter in enumerate(intro.chapters):
-            await q.put((i, chapter))
+def batch(iterable, n=1):
+    l = len(iterable)
+    for ndx in range(0, l, n):
+        yield iterable[ndx:min(ndx + n, l)]
 
-        await q.join()
-        for w in workers:
-            w.cancel()
-        await asyncio.gather(*workers, return_exceptions=True)
+def new_update_chapter(chapter: Chapters, intro: Intro) -> EpubHtml:
+    update_chapter = epub.EpubHtml(title=str(chapter.txt), file_name=chapter.new_href,
+                                   lang=intro.language)  # TODO: fix language
+    update_chapter.add_item(get_style_item())
+    return update_chapter
 
-    pages = [p for _, p in sorted(pages_indexed, key=lambda x: x[0])]
 
-    for p in tqdm(pages, desc="Adding pages to book"):
-        add_page(known_images, book, toc, spine, p)
+async def build_update(images: ImageScheduler, chapter: Chapters, data: TransformedUpdate, intro: Intro) -> Page:
+    update_chapter = new_update_chapter(chapter, intro)
 
-    writer("preparing book structure")
-    book.toc = toc
+    # the intro goes first, then chapters in reading order
+    fetched = await images.get_all(data.images, chapter.num + 1)
 
-    book.add_item(epub.EpubNcx())
-    book.add_item(epub.EpubNav())
+    update_chapter.content = place_images(data, fetched)
 
-    book.spine = spine
+    return Page(chapter.num, update_chapter, fetched)
 
-    book.add_item(get_style_item())
+
+def add_page(known_images: dict, book: EpubBook, toc: List, spine: List, page: Page, out: StreamingEpubWriter | None = None):
+    book.add_item(page.chapter)
+    if out:
+        out.write_item(page.chapter)
+    for img in page.images:
+        if img.hash not in known_images["hashes"]:
+            book.add_item(img.data)
+            known_images["hashes"].append(img.hash)
+            if out:
+                out.write_item(img.data)
+        elif out:
+            out.release_item(img.data)
+    toc.append(epub.Link(page.chapter.file_name, page.chapter.title, page.chapter.id))
+    spine.append(page.chapter)
+
+
+async def build_single_page(session: aiohttp.ClientSession, intro: Intro, chapter: Chapters, all_chapters: ChapterIndex, pbar,
+                            images: ImageScheduler, limiter: PerHostLimiter | None = None,
+                            transformer: "Transformer | None" = None, retry: RetryPolicy | None = None) -> Page:
+    if transformer is None:
+        transformer = Transformer(all_chapters, workers=0)
+    # the page body is read before its images are fetched so the page does not hold a limiter slot meanwhile
+    page_text = await get_resource_with_retries(session, chapter.original_href, limiter=limiter, retry=retry)
+    update = await transformer.transform(page_text, chapter.num)
+    u = await build_update(images, chapter, update, intro)
+    pbar.update(1)
+    return u
+
+
+def reused_images(refs: List[JournaledImageRef]) -> List[IndexedEpubImage]:
+    return [
+        IndexedEpubImage(num=x.num, hash=x.hash, old_name=x.old_name, new_name=x.new_name, root_url=x.root_url,
+                         data=SpooledEpubImage(uid=f"i{x.hash}", file_name=f"images/{x.hash}.{x.media_type.split('/')[1]}",
+                                               media_type=x.media_type, source=x.source))
+        for x in refs
+    ]
+
+
+def page_from_journal(journal: Journal, chapter: Chapters, intro: Intro) -> Page | None:
+    journaled = journal.load(chapter.num, chapter.original_href, str(chapter.txt))
+    if journaled is None:
+        return None
+    update_chapter = new_update_chapter(chapter, intro)
+    update_chapter.content = journaled.content
+    return Page(chapter.num, update_chapter, reused_images(journaled.images))
+
+
+def page_from_previous(previous: PreviousBook, chapter: Chapters, intro: Intro) -> Page | None:
+    kept = previous.load(chapter.num, chapter.original_href, str(chapter.txt))
+    if kept is None:
+        return None
+    update_chapter = PrebuiltEpubHtml(kept.xhtml, title=str(chapter.txt), file_name=chapter.new_href,
+                                      lang=intro.language)
+    update_chapter.add_item(get_style_item())
+    return Page(chapter.num, update_chapter, reused_images(kept.images))
+
+
+def manifest_entry(chapter: Chapters, page: Page) -> dict:
+    return {
+        "num": chapter.num,
+        "href": chapter.original_href,
+        "title": str(chapter.txt),
+        "file_name": chapter.new_href,
+        "images": [
+            {"num": x.num, "hash": x.hash, "old_name": x.old_name, "new_name": x.new_name, "root_url": x.root_url,
+             "media_type": x.data.media_type}
+            for x in page.images
+        ],
+    }
+
+
+async def lparchive2epub(url: str, file: str, root_session: aiohttp.ClientSession | None = None, writer=tqdm.write,
+                         limiter: PerHostLimiter | None = None, image_memory_budget: int = DEFAULT_MEMORY_BUDGET,
+                         spool_dir: str | None = None, resume: bool = True, previous: str | None = None,
+                         transform_workers: int | None = None, parser: str = DEFAULT_PARSER,
+                         image_store: ImageStore | None = None, shrink: ShrinkOptions | None = None,
+                         shrink_cache: ShrinkCache | None = None, retry: RetryPolicy | None = None):
+    if url.endswith("/"):
+        url = url[:-1]
+    if root_session is None:
+        root_session = aiohttp.ClientSession(trace_configs=[network_trace()])
+    if limiter is None:
+        limiter = PerHostLimiter()
+    spool = ImageSpool(image_memory_budget, spool_dir)
+    try:
+        async with root_session as session:
+            await do(url, file, session, writer, limiter, spool, resume, previous, transform_workers, parser,
+                     image_store, shrink, shrink_cache, retry)
+    finally:
+        spool.close()
+
+
+@dataclass(slots=True)
+class LandingSummary:
+    published_on: str
+    chapters: int
+
+
+async def get_landing_summary(session: aiohttp.ClientSession, url: str, limiter: PerHostLimiter | None = None,
+                              parser: str = DEFAULT_PARSER, retry: RetryPolicy | None = None) -> LandingSummary:
+    # enough of the landing page to tell whether a let's play changed since its book was made
+    page_text = await get_resource_with_retries(session, url, limiter=limiter, retry=retry)
+    content = get_cleaned_html(page_text, parser, CONTENT_ONLY)
+    metadata = BeautifulSoup(page_text, parser, parse_only=LANDING_METADATA)
+    return LandingSummary(published_on=metadata.find("li", id="archival").find("strong").text,
+                          chapters=len(Extractor.all_chapters(url, content)))
+
+
+async def do(url: str, file: str, session: aiohttp.ClientSession, writer, limiter: PerHostLimiter | None = None,
+             spool: ImageSpool | None = None, resume: bool = True, previous: str | None = None,
+             transform_workers: int | None = None, parser: str = DEFAULT_PARSER,
+             image_store: ImageStore | None = None, shrink: ShrinkOptions | None = None,
+             shrink_cache: ShrinkCache | None = None, retry: RetryPolicy | None = None):
+    if limiter is None:
+        limiter = PerHostLimiter()
+    if spool is None:
+        spool = ImageSpool()
+    if retry is None:
+        # one retry budget for every request of the book
+        retry = RetryPolicy()
+    if shrink is not None and not pillow_available():
+        raise RuntimeError("shrinking images needs Pillow (pip install pillow)")
+    resolved = resolve_parser(parser)
+    if resolved != parser and parser != "auto":
+        writer(f"{parser} is not installed, using {resolved}")
+    parser = resolved
+    writer(f"extracting lp from {url}")
+    writer("getting landing page")
+    page_text = await get_resource_with_retries(session, url, limiter=limiter, retry=retry)
+
+    landing = get_cleaned_html(page_text, parser, CONTENT_ONLY)
+    metadata = BeautifulSoup(page_text, parser, parse_only=LANDING_METADATA)
+
+    book = epub.EpubBook()
+    intro = Extractor.intro(url, landing, metadata)
 
     book.add_author(intro.author)
     book.set_title(intro.title)
@@ -544,5 +791,141 @@ async def do(url: str, file: str, session: aiohttp.ClientSession, writer):
 
     mtime = datetime.datetime.strptime(intro.published_on, "%b %d, %Y")
 
-    writer("Writing book file")
-    epub.write_epub(file, book, options = {"mtime": mtime})
+    toc = []
+    spine = ["nav"]
+
+    known_images = {
+        "hashes": [],
+    }
+
+    # chapters whose number, href and title didn't change are copied from the book being updated
+    previous_book = None
+    if previous is not None:
+        previous_book = PreviousBook(previous, url)
+        writer(f"updating {previous}, {len(previous_book.chapters)} chapters already there")
+    manifest = {}
+
+    # finished chapters are checkpointed next to the output until the book is complete, so a failed run
+    # only has to fetch what it was missing the next time
+    if not resume and os.path.exists(journal_path(file)):
+        os.remove(journal_path(file))
+    journal = Journal(journal_path(file), url)
+    if journal.completed():
+        writer(f"resuming, {journal.completed()} chapters already done")
+
+    # chapters are written to the book as soon as they and every chapter before them are done,
+    # so only the pages inside the reorder window are ever held in memory.
+    # the store may be shared with other conversions
+    store_hits = image_store.hits if image_store is not None else 0
+
+    out = StreamingEpubWriter(file, book, options={"mtime": mtime})
+    try:
+        transformer = Transformer(intro.chapter_index, transform_workers, parser)
+        # images are shrunk in the processes of the page transform, entered first and closed last
+        shrinker = ImageShrinker(shrink, spool, shrink_cache, transformer) if shrink is not None else None
+        async with transformer, \
+                ImageScheduler(session, limiter, spool=spool, store=image_store, shrinker=shrinker,
+                               retry=retry) as images:
+            writer("building intro")
+            epub_intro = await build_intro(images, url, intro)
+            intro.intro = None
+            del landing, metadata
+            # chapters reuse intro images, which are released once the intro is written
+            await asyncio.to_thread(journal.store_images, epub_intro.images)
+
+            add_page(known_images, book, toc, spine, epub_intro, out)
+
+            writer("building chapters / updates")
+
+            with tqdm(total=len(intro.chapters), desc="Gathering and building pages") as pbar:
+                buffer = ReorderBuffer(functools.partial(add_page, known_images, book, toc, spine, out=out))
+                q: asyncio.Queue = asyncio.Queue()
+                failed = asyncio.Event()
+                errors: list[Exception] = []
+
+                async def worker():
+                    while True:
+                        try:
+                            chapter = await q.get()
+                            try:
+                                await buffer.reserve(chapter.num)
+                                page = page_from_journal(journal, chapter, intro)
+                                if page is None and previous_book is not None:
+                                    page = page_from_previous(previous_book, chapter, intro)
+                                if page is None:
+                                    page = await build_single_page(session, intro, chapter, intro.chapter_index, pbar,
+                                                                   images, limiter, transformer, retry)
+                                    # recorded before the buffer writes the page and releases its images
+                                    await asyncio.to_thread(journal.record, chapter.num, chapter.original_href,
+                                                            page.chapter.title, page.chapter.content, page.images)
+                                else:
+                                    pbar.update(1)
+                                manifest[chapter.num] = manifest_entry(chapter, page)
+                                await buffer.push(chapter.num, page)
+                                pbar.set_postfix(window=f"{limiter.for_url(chapter.original_href).window:.1f}",
+                                                 buffered=len(buffer))
+                            except Exception as e:
+                                errors.append(e)
+                                failed.set()
+                            finally:
+                                q.task_done()
+                        except asyncio.CancelledError:
+                            break
+
+                workers = [asyncio.create_task(worker()) for _ in range(CONCURRENCY_LIMIT_PAGES)]
+
+                for chapter in intro.chapters:
+                    q.put_nowait(chapter)
+
+                # a failed chapter would stall the reorder buffer, so stop at the first one
+                join = asyncio.create_task(q.join())
+                stop = asyncio.create_task(failed.wait())
+                await asyncio.wait([join, stop], return_when=asyncio.FIRST_COMPLETED)
+                for t in [join, stop, *workers]:
+                    t.cancel()
+                await asyncio.gather(join, stop, *workers, return_exceptions=True)
+
+                if errors:
+                    raise errors[0]
+
+        for m in limiter.metrics():
+            writer(f"concurrency {format_metrics(m)}")
+        if images.failed:
+            writer(f"{len(images.failed)} images could not be fetched, the book links to them instead:")
+            for image_url, error in images.failed.items():
+                writer(f"  {image_url}: {error}")
+        if spool.spilled:
+            writer(f"{spool.spilled} images went over the in-memory budget and were spooled to disk")
+        if image_store is not None and image_store.hits > store_hits:
+            writer(f"{image_store.hits - store_hits} images taken from the image store")
+        if shrinker is not None:
+            writer(f"images shrunk from {shrinker.before / 2 ** 20:.1f} MB to {shrinker.after / 2 ** 20:.1f} MB")
+
+        if previous_book is not None:
+            # the chapters kept from it are read on the writer thread, and it may be the file about to be replaced
+            await asyncio.to_thread(out.drain)
+            previous_book.close()
+        out.write_file(MANIFEST_NAME, json.dumps({
+            "url": url,
+            "chapters": [manifest[k] for k in sorted(manifest)],
+        }, indent=1))
+
+        writer("preparing book structure")
+        book.toc = toc
+
+        book.add_item(epub.EpubNcx())
+        book.add_item(epub.EpubNav())
+
+        book.spine = spine
+
+        book.add_item(get_style_item())
+
+        writer("Writing book file")
+        await asyncio.to_thread(out.finish)
+    except BaseException:
+        out.abort()
+        journal.close()
+        if previous_book is not None:
+            previous_book.close()
+        raise
+    journal.discard()
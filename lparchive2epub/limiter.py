@@ -0,0 +1,352 @@
+import asyncio
+import multiprocessing
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import Deque, Dict, List
+from urllib.parse import urlparse
+
+import aiohttp
+
+# AIMD defaults: start small, grow by ~1 slot per window of healthy responses, halve on congestion
+INITIAL_WINDOW = 4.0
+MIN_WINDOW = 1.0
+MAX_WINDOW = 32.0
+INCREASE_STEP = 1.0
+DECREASE_FACTOR = 0.5
+
+# A response slower than this multiple of the best latency seen for the host holds the window
+LATENCY_TOLERANCE = 4.0
+
+BACKOFF_STATUSES = frozenset({429, 500, 502, 503, 504})
+CONGESTION_ERRORS = (asyncio.TimeoutError, aiohttp.ServerDisconnectedError, aiohttp.ClientConnectionError)
+
+DECISION_HISTORY = 256
+
+# A circuit breaker opens after this many disconnects or timeouts within the window, and lets a probe through
+# after the pause
+BREAKER_THRESHOLD = 8
+BREAKER_WINDOW = 30.0
+BREAKER_PAUSE = 30.0
+BREAKER_POLL = 0.5
+
+
+@dataclass
+class LimiterDecision:
+    at: float
+    action: str
+    reason: str
+    window: float
+
+
+@dataclass
+class LimiterMetrics:
+    host: str
+    window: float
+    peak_window: float
+    in_flight: int
+    requests: int
+    increases: int
+    decreases: int
+    holds: int
+    min_latency: float | None
+    decisions: List[LimiterDecision] = field(default_factory=list)
+
+
+@dataclass
+class Slot:
+    status: int | None = None
+    # answered by the session's cache, a revalidated response was sent all the same
+    from_cache: bool = False
+    # set once the request leaves for the network, see network_trace
+    sent: bool = False
+    # time spent in the rate limit once sent, left out of the latency and pushed back on `timeout`
+    waited: float = 0.0
+    timeout: asyncio.Timeout | None = None
+    rate_limit: "RateLimit | None" = None
+
+    async def sending(self):
+        self.sent = True
+        if self.rate_limit is None:
+            return
+        started = time.monotonic()
+        await self.rate_limit.wait()
+        waited = time.monotonic() - started
+        self.waited += waited
+        if self.timeout is not None and self.timeout.when() is not None:
+            self.timeout.reschedule(self.timeout.when() + waited)
+
+    @property
+    def cached(self) -> bool:
+        # says nothing about the host, and its latency would be the window's best
+        return self.from_cache and not self.sent
+
+
+def network_trace() -> aiohttp.TraceConfig:
+    # For sessions whose requests are passed their slot as trace_request_ctx: a response from the session's cache
+    # never starts a request, so only the ones going to the network wait for the rate limit
+    async def on_request_start(session, context, params):
+        if isinstance(context.trace_request_ctx, Slot):
+            await context.trace_request_ctx.sending()
+
+    trace = aiohttp.TraceConfig()
+    trace.on_request_start.append(on_request_start)
+    return trace
+
+
+class AimdLimiter:
+
+    def __init__(self, host: str = "", initial: float = INITIAL_WINDOW, minimum: float = MIN_WINDOW,
+                 maximum: float = MAX_WINDOW, latency_tolerance: float = LATENCY_TOLERANCE):
+        self.host = host
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_tolerance = latency_tolerance
+        self.window = min(max(initial, minimum), maximum)
+        self.peak_window = self.window
+        self.in_flight = 0
+        self.min_latency: float | None = None
+        self.requests = 0
+        self.increases = 0
+        self.decreases = 0
+        self.holds = 0
+        self.decisions: Deque[LimiterDecision] = deque(maxlen=DECISION_HISTORY)
+        self._last_decrease = 0.0
+        self._condition = asyncio.Condition()
+
+    def _has_room(self) -> bool:
+        return self.in_flight < int(self.window)
+
+    async def acquire(self) -> float:
+        async with self._condition:
+            await self._condition.wait_for(self._has_room)
+            self.in_flight += 1
+        return time.monotonic()
+
+    async def release(self, started: float, status: int | None = None, error: BaseException | None = None,
+                      waited: float = 0.0, cached: bool = False):
+        latency = time.monotonic() - started - waited
+        async with self._condition:
+            self.in_flight -= 1
+            if not cached:
+                self.requests += 1
+                self._record(started, latency, status, error)
+            self._condition.notify_all()
+
+    @asynccontextmanager
+    async def slot(self):
+        s = Slot()
+        started = await self.acquire()
+        try:
+            yield s
+        except BaseException as e:
+            await self.release(started, s.status, e, s.waited, s.cached)
+            raise
+        else:
+            await self.release(started, s.status, waited=s.waited, cached=s.cached)
+
+    def _decide(self, action: str, reason: str):
+        self.decisions.append(LimiterDecision(at=time.time(), action=action, reason=reason, window=self.window))
+
+    def _record(self, started: float, latency: float, status: int | None, error: BaseException | None):
+        if isinstance(error, CONGESTION_ERRORS):
+            self._decrease(started, type(error).__name__)
+        elif status in BACKOFF_STATUSES:
+            self._decrease(started, f"status {status}")
+        elif error is not None or status is None or status >= 400:
+            # not a congestion signal (404, parse error, cancellation...): leave the window alone
+            return
+        else:
+            self._increase(latency)
+
+    def _increase(self, latency: float):
+        if self.min_latency is None or latency < self.min_latency:
+            self.min_latency = latency
+        if latency > self.min_latency * self.latency_tolerance and latency > 0.05:
+            self.holds += 1
+            self._decide("hold", f"latency {latency:.2f}s")
+            return
+        if self.window >= self.maximum:
+            return
+        before = int(self.window)
+        self.window = min(self.maximum, self.window + INCREASE_STEP / self.window)
+        self.peak_window = max(self.peak_window, self.window)
+        if int(self.window) > before:
+            self.increases += 1
+            self._decide("increase", f"latency {latency:.2f}s")
+
+    def _decrease(self, started: float, reason: str):
+        # requests already in flight when we last backed off belong to the same congestion event
+        if started <= self._last_decrease:
+            return
+        self._last_decrease = time.monotonic()
+        if self.window <= self.minimum:
+            return
+        self.window = max(self.minimum, self.window * DECREASE_FACTOR)
+        self.decreases += 1
+        self._decide("decrease", reason)
+
+    def metrics(self) -> LimiterMetrics:
+        return LimiterMetrics(
+            host=self.host,
+            window=self.window,
+            peak_window=self.peak_window,
+            in_flight=self.in_flight,
+            requests=self.requests,
+            increases=self.increases,
+            decreases=self.decreases,
+            holds=self.holds,
+            min_latency=self.min_latency,
+            decisions=list(self.decisions),
+        )
+
+
+class RateLimit:
+    # Spaces requests at least 1/rate seconds apart, across every process sharing it. The next free time
+    # lives in shared memory, so it has to be created before the processes using it are started.
+
+    def __init__(self, rate: float, context=None):
+        context = context or multiprocessing.get_context("spawn")
+        self.interval = 1.0 / rate
+        self._next = context.Value("d", 0.0)
+
+    def reserve(self) -> float:
+        # wall clock, monotonic clocks aren't comparable between processes everywhere
+        with self._next.get_lock():
+            now = time.time()
+            at = max(now, self._next.value)
+            self._next.value = at + self.interval
+        return at - now
+
+    async def wait(self):
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class CircuitBreaker:
+    # Stops every process sharing it from hammering a host that started refusing connections. A burst of
+    # disconnects and timeouts opens it, requests to the host then wait until a single probe request, let through
+    # after the pause, gets an answer. Like RateLimit it lives in shared memory, so create it before the processes.
+    CLOSED, OPEN, PROBING = 0, 1, 2
+
+    def __init__(self, host: str, threshold: int = BREAKER_THRESHOLD, window: float = BREAKER_WINDOW,
+                 pause: float = BREAKER_PAUSE, context=None):
+        context = context or multiprocessing.get_context("spawn")
+        self.host = host
+        self.threshold = threshold
+        self.window = window
+        self.pause = pause
+        self._lock = context.Lock()
+        self._state = context.Value("i", self.CLOSED, lock=False)
+        self._failures = context.Value("i", 0, lock=False)
+        self._first_failure = context.Value("d", 0.0, lock=False)
+        # wall clock, like RateLimit; when a probe may be sent, or another one if the last probe never came back
+        self._retry_at = context.Value("d", 0.0, lock=False)
+        self._trips = context.Value("i", 0, lock=False)
+
+    def covers(self, url: str) -> bool:
+        host = urlparse(url).netloc
+        return host == self.host or host.endswith(f".{self.host}")
+
+    @property
+    def trips(self) -> int:
+        return self._trips.value
+
+    @property
+    def closed(self) -> bool:
+        return self._state.value == self.CLOSED
+
+    def _enter(self) -> bool:
+        with self._lock:
+            if self._state.value == self.CLOSED:
+                return True
+            now = time.time()
+            if now < self._retry_at.value:
+                return False
+            self._state.value = self.PROBING
+            self._retry_at.value = now + self.pause
+            return True
+
+    async def wait(self):
+        while not self._enter():
+            await asyncio.sleep(BREAKER_POLL)
+
+    def failure(self):
+        with self._lock:
+            now = time.time()
+            if self._state.value == self.PROBING:
+                self._state.value = self.OPEN
+                self._retry_at.value = now + self.pause
+                return
+            if self._state.value == self.OPEN:
+                return
+            if now - self._first_failure.value > self.window:
+                self._failures.value = 0
+                self._first_failure.value = now
+            self._failures.value += 1
+            if self._failures.value >= self.threshold:
+                self._state.value = self.OPEN
+                self._retry_at.value = now + self.pause
+                self._failures.value = 0
+                self._trips.value += 1
+
+    def success(self):
+        if self._state.value == self.CLOSED and self._failures.value == 0:
+            return
+        with self._lock:
+            self._failures.value = 0
+            # only the probe closes it, answers to requests sent before it opened prove nothing
+            if self._state.value == self.PROBING:
+                self._state.value = self.CLOSED
+
+
+class PerHostLimiter:
+    # The rate limit is only waited for by requests of sessions made with network_trace(), like the ones of a
+    # ConnectionPool, once they go to the network
+
+    def __init__(self, rate_limit: RateLimit | None = None, breaker: CircuitBreaker | None = None, **kwargs):
+        self.rate_limit = rate_limit
+        self.breaker = breaker
+        self._kwargs = kwargs
+        self._limiters: Dict[str, AimdLimiter] = {}
+
+    def for_url(self, url: str) -> AimdLimiter:
+        host = urlparse(url).netloc
+        if host not in self._limiters:
+            self._limiters[host] = AimdLimiter(host, **self._kwargs)
+        return self._limiters[host]
+
+    @asynccontextmanager
+    async def slot(self, url: str):
+        breaker = self.breaker if self.breaker is not None and self.breaker.covers(url) else None
+        if breaker is not None:
+            await breaker.wait()
+        async with self.for_url(url).slot() as s:
+            s.rate_limit = self.rate_limit
+            if breaker is None:
+                yield s
+                return
+            try:
+                yield s
+            except CONGESTION_ERRORS:
+                breaker.failure()
+                raise
+            except Exception:
+                # the host answered, even if it was an error status
+                if not s.cached:
+                    breaker.success()
+                raise
+            else:
+                # a cache hit letting the probe close it would send everyone back to a host that is still down
+                if not s.cached:
+                    breaker.success()
+
+    def metrics(self) -> List[LimiterMetrics]:
+        return [x.metrics() for x in self._limiters.values()]
+
+
+def format_metrics(m: LimiterMetrics) -> str:
+    return (f"{m.host}: window {m.window:.1f} (peak {m.peak_window:.1f}), {m.requests} requests, "
+            f"{m.increases} increases, {m.decreases} decreases, {m.holds} holds")
@@ -1,10 +1,17 @@
 import asyncio
+import os
 from argparse import ArgumentParser, ArgumentTypeError
 from urllib.parse import urlparse
 
-from aiohttp_client_cache import CacheBackend, CachedSession
+from aiohttp_client_cache import CachedSession
+from tqdm import tqdm
 
-from lparchive2epub.lib import lparchive2epub
+from lparchive2epub.cache import DEFAULT_CACHE_MAX_SIZE, PersistentCache, default_cache_dir
+from lparchive2epub.lib import DEFAULT_PARSER, PARSERS, lparchive2epub
+from lparchive2epub.limiter import network_trace
+from lparchive2epub.shrink import DEFAULT_QUALITY, SHRINK_CACHE_FILE_NAME, ShrinkCache, ShrinkOptions, pillow_available
+from lparchive2epub.spool import DEFAULT_MEMORY_BUDGET
+from lparchive2epub.store import ImageStore
 
 
 def is_lparchive_url(arg):
@@ -24,16 +31,74 @@ arg_parser = ArgumentParser(
 arg_parser.add_argument("url", metavar="URL", nargs=1, type=is_lparchive_url)
 arg_parser.add_argument("output", metavar="OUTPUT_FILE", nargs=1, type=str)
 arg_parser.add_argument("--no-cache", action="store_true", help="Don't cache url calls")
+arg_parser.add_argument("--cache-dir", metavar="DIR", type=str, default=default_cache_dir(),
+                        help="Where to keep the url cache between runs (default: %(default)s)")
+arg_parser.add_argument("--cache-max-size", metavar="MB", type=int, default=DEFAULT_CACHE_MAX_SIZE // (1024 * 1024),
+                        help="Size of the url cache above which least recently used entries are evicted "
+                             "(default: %(default)s)")
+arg_parser.add_argument("--revalidate", action="store_true",
+                        help="Check cached pages with lparchive (ETag / Last-Modified) so edited updates are picked "
+                             "up, unchanged ones only cost a 304; images stay cached")
+arg_parser.add_argument("--image-memory", metavar="MB", type=int, default=DEFAULT_MEMORY_BUDGET // (1024 * 1024),
+                        help="Image bytes kept in memory before spooling to disk (default: %(default)s)")
+arg_parser.add_argument("--spool-dir", metavar="DIR", type=str, default=None,
+                        help="Where to spool images over the memory budget (default: system temp dir)")
+arg_parser.add_argument("--image-store", metavar="FILE", type=str, default=None,
+                        help="SQLite file of images shared between conversions, images found there are not downloaded")
+arg_parser.add_argument("--transform-workers", metavar="N", type=int, default=None,
+                        help="Processes parsing and rewriting pages, 0 to do it in the main process "
+                             "(default: one per CPU)")
+arg_parser.add_argument("--parser", choices=PARSERS + ["auto"], default=DEFAULT_PARSER,
+                        help="HTML parser backend, falls back to html.parser when not installed (default: %(default)s)")
+arg_parser.add_argument("--update", action="store_true",
+                        help="Reuse the chapters and images of an existing OUTPUT_FILE and only fetch new or changed "
+                             "updates")
+arg_parser.add_argument("--no-resume", action="store_true",
+                        help="Ignore the journal left next to OUTPUT_FILE by a failed run and start over")
+arg_parser.add_argument("--shrink-images", action="store_true",
+                        help="Re-encode images to make the book smaller, needs Pillow")
+arg_parser.add_argument("--max-image-size", metavar="PX", type=int, default=None,
+                        help="With --shrink-images, downscale images larger than PX on their longest side")
+arg_parser.add_argument("--image-quality", metavar="Q", type=int, default=DEFAULT_QUALITY,
+                        help="With --shrink-images, JPEG and WebP quality (default: %(default)s)")
+arg_parser.add_argument("--first-frame", action="store_true",
+                        help="With --shrink-images, keep only the first frame of animated images")
 
 async def amain(args):
     if args.no_cache:
+        backend = None
         cache = None
     else:
-        cache = CachedSession(cache=CacheBackend())
-    await lparchive2epub(args.url[0], args.output[0], cache)
+        backend = PersistentCache(args.cache_dir, args.cache_max_size * 1024 * 1024, revalidate_pages=args.revalidate)
+        # revalidated pages are told apart from plain cache hits by the trace
+        cache = CachedSession(cache=backend, trace_configs=[network_trace()])
+    image_store = ImageStore(args.image_store) if args.image_store else None
+    shrink, shrink_cache = None, None
+    if args.shrink_images:
+        shrink = ShrinkOptions(max_dimension=args.max_image_size, quality=args.image_quality,
+                               first_frame=args.first_frame)
+        if not args.no_cache:
+            os.makedirs(args.cache_dir, exist_ok=True)
+            shrink_cache = ShrinkCache(os.path.join(args.cache_dir, SHRINK_CACHE_FILE_NAME))
+    try:
+        await lparchive2epub(args.url[0], args.output[0], cache,
+                             image_memory_budget=args.image_memory * 1024 * 1024, spool_dir=args.spool_dir,
+                             resume=not args.no_resume, transform_workers=args.transform_workers,
+                             parser=args.parser,
+                             previous=args.output[0] if args.update and os.path.exists(args.output[0]) else None,
+                             image_store=image_store, shrink=shrink, shrink_cache=shrink_cache)
+    finally:
+        if image_store:
+            image_store.close()
+        if shrink_cache:
+            shrink_cache.close()
+    if backend:
+        tqdm.write(backend.report())
 
 def main():
     args = arg_parser.parse_args()
+    if args.shrink_images and not pillow_available():
+        arg_parser.error("--shrink-images needs Pillow (pip install pillow)")
     asyncio.run(amain(args))
 
 
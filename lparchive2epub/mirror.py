@@ -0,0 +1,65 @@
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from hashlib import blake2b
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS builds (
+    url TEXT PRIMARY KEY,
+    published_on TEXT,
+    chapters INTEGER,
+    output_hash TEXT,
+    built_at REAL
+);
+"""
+
+
+@dataclass
+class BuildRecord:
+    url: str
+    published_on: str
+    chapters: int
+    output_hash: str
+    built_at: float
+
+    def matches(self, published_on: str, chapters: int) -> bool:
+        return self.published_on == published_on and self.chapters == chapters
+
+
+def file_hash(path: str) -> str:
+    hasher = blake2b()
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class MirrorManifest:
+    # What every book of a mirror was built from, so a refresh only rebuilds the let's plays whose landing page
+    # shows a new archival date or chapter count.
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._db.executescript(SCHEMA)
+        self._db.commit()
+
+    def get(self, url: str) -> BuildRecord | None:
+        with self._lock:
+            row = self._db.execute("SELECT url, published_on, chapters, output_hash, built_at FROM builds WHERE url=?",
+                                   (url,)).fetchone()
+        return BuildRecord(*row) if row else None
+
+    def record(self, url: str, published_on: str, chapters: int, output: str) -> BuildRecord:
+        entry = BuildRecord(url=url, published_on=published_on, chapters=chapters, output_hash=file_hash(output),
+                            built_at=time.time())
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO builds VALUES (?, ?, ?, ?, ?)",
+                             (entry.url, entry.published_on, entry.chapters, entry.output_hash, entry.built_at))
+        return entry
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,70 @@
+import json
+import threading
+import zipfile
+from dataclasses import dataclass
+from typing import List
+
+from lparchive2epub.journal import JournaledImage, JournaledImageRef
+
+# Chapter list of a book, written next to the container so the book can be updated later
+MANIFEST_NAME = "META-INF/lparchive2epub.json"
+BOOK_FOLDER = "EPUB"
+
+
+@dataclass
+class PreviousChapter:
+    num: int
+    title: str
+    file_name: str
+    xhtml: bytes
+    images: List[JournaledImageRef]
+
+
+class PreviousBook:
+    # A book written by an earlier run, whose chapters and images are reused when the let's play gained updates.
+    # Chapters are matched on their number, href and title; anything else is fetched again.
+
+    def __init__(self, path: str, url: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._zip = zipfile.ZipFile(path)
+        try:
+            manifest = json.loads(self._zip.read(MANIFEST_NAME))
+        except KeyError:
+            self._zip.close()
+            raise RuntimeError(f"{path} has no chapter list, it can't be updated")
+        if manifest["url"] != url:
+            self._zip.close()
+            raise RuntimeError(f"{path} was made from {manifest['url']}, not {url}")
+        self.chapters = {c["num"]: c for c in manifest["chapters"]}
+        # its links to the updates that followed could not be resolved back then
+        self.last = max(self.chapters, default=None)
+        self._sizes = {}
+        for c in manifest["chapters"]:
+            for i in c["images"]:
+                self._sizes[i["hash"]] = self._zip.getinfo(self._image_path(i["hash"], i["media_type"])).file_size
+        self._media_types = {i["hash"]: i["media_type"] for c in manifest["chapters"] for i in c["images"]}
+
+    @staticmethod
+    def _image_path(digest: str, media_type: str) -> str:
+        return f"{BOOK_FOLDER}/images/{digest}.{media_type.split('/')[1]}"
+
+    def load(self, num: int, href: str, title: str) -> PreviousChapter | None:
+        c = self.chapters.get(num)
+        if c is None or num == self.last or c["href"] != href or c["title"] != title:
+            return None
+        with self._lock:
+            xhtml = self._zip.read(f"{BOOK_FOLDER}/{c['file_name']}")
+        return PreviousChapter(num=num, title=title, file_name=c["file_name"], xhtml=xhtml, images=[
+            JournaledImageRef(num=i["num"], hash=i["hash"], old_name=i["old_name"], new_name=i["new_name"],
+                              root_url=i["root_url"], media_type=i["media_type"],
+                              source=JournaledImage(self, i["hash"], self._sizes[i["hash"]]))
+            for i in c["images"]
+        ])
+
+    def image_data(self, digest: str) -> bytes:
+        with self._lock:
+            return self._zip.read(self._image_path(digest, self._media_types[digest]))
+
+    def close(self):
+        self._zip.close()
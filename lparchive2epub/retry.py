@@ -0,0 +1,114 @@
+import asyncio
+import email.utils
+import random
+import time
+from typing import Dict
+from urllib.parse import urlparse
+
+import aiohttp
+
+# Full jitter backoff: a random wait between 0 and min(BACKOFF_CAP, BACKOFF_BASE * 2^attempt)
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 30.0
+MAX_ATTEMPTS = 5
+ATTEMPT_TIMEOUT = 60.0
+DEADLINE = 180.0
+# A server asking for a longer wait than this is as good as down
+MAX_RETRY_AFTER = 120.0
+
+# Every host starts with this many retries; successes earn a fraction of one back
+BUDGET_RETRIES = 50
+BUDGET_REFILL = 0.2
+
+# The resource is gone or never was, asking again won't change it
+PERMANENT_STATUSES = frozenset({400, 401, 403, 404, 405, 410, 414, 451})
+# The server is asking to come back later, and may say when in Retry-After
+THROTTLING_STATUSES = frozenset({429, 503})
+CONNECTION_ERRORS = (aiohttp.ServerDisconnectedError, aiohttp.ClientConnectionError, ConnectionResetError)
+TRANSIENT_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, OSError)
+
+
+class HttpStatusError(RuntimeError):
+
+    def __init__(self, url: str, status: int, retry_after: float | None = None):
+        super().__init__(f"Failed to get resource {url}, status code: {status}")
+        self.status = status
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    # either a number of seconds or an http date
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+
+class RetryBudget:
+    # Retries allowed per host for the whole run. Each retry spends one and each success earns a fraction back,
+    # so a host that answers most requests keeps its budget while one that is down exhausts it quickly and
+    # every request to it then fails at once instead of backing off for minutes.
+
+    def __init__(self, retries: float = BUDGET_RETRIES, refill: float = BUDGET_REFILL):
+        self.retries = retries
+        self.refill = refill
+        self._left: Dict[str, float] = {}
+
+    def spend(self, url: str) -> bool:
+        host = urlparse(url).netloc
+        left = self._left.get(host, self.retries)
+        if left < 1:
+            return False
+        self._left[host] = left - 1
+        return True
+
+    def earn(self, url: str):
+        host = urlparse(url).netloc
+        self._left[host] = min(self.retries, self._left.get(host, self.retries) + self.refill)
+
+    def left(self, url: str) -> float:
+        return self._left.get(urlparse(url).netloc, self.retries)
+
+
+class RetryPolicy:
+    # How get_resource_with_retries retries: which failures are worth it, how long to wait in between,
+    # and how long a single attempt and the whole request may take. One per run, since it holds the budget.
+
+    def __init__(self, attempts: int = MAX_ATTEMPTS, base: float = BACKOFF_BASE, cap: float = BACKOFF_CAP,
+                 attempt_timeout: float = ATTEMPT_TIMEOUT, deadline: float = DEADLINE,
+                 max_retry_after: float = MAX_RETRY_AFTER, budget: RetryBudget | None = None):
+        self.attempts = attempts
+        self.base = base
+        self.cap = cap
+        self.attempt_timeout = attempt_timeout
+        self.deadline = deadline
+        self.max_retry_after = max_retry_after
+        self.budget = budget if budget is not None else RetryBudget()
+
+    def backoff(self, attempt: int) -> float:
+        # jittered so the page workers that failed together don't all come back together
+        return random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+
+    def delay(self, attempt: int, error: BaseException) -> float | None:
+        # seconds to wait before the next attempt, None when the error isn't worth retrying
+        if isinstance(error, HttpStatusError):
+            if error.status in PERMANENT_STATUSES:
+                return None
+            if error.status in THROTTLING_STATUSES and error.retry_after is not None:
+                if error.retry_after > self.max_retry_after:
+                    return None
+                return error.retry_after
+            return self.backoff(attempt)
+        if isinstance(error, CONNECTION_ERRORS) and attempt == 1:
+            # most likely a kept-alive connection the server closed, a new one usually works right away
+            return 0.0
+        if isinstance(error, TRANSIENT_ERRORS):
+            return self.backoff(attempt)
+        return None
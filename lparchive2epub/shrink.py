@@ -0,0 +1,132 @@
+import asyncio
+import importlib.util
+import io
+import sqlite3
+import threading
+from dataclasses import dataclass
+
+from lparchive2epub.spool import ImageSpool, SpooledImage
+
+# Kept in the url cache directory
+SHRINK_CACHE_FILE_NAME = "shrunk_images.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS shrunk (hash TEXT, options TEXT, data BLOB, PRIMARY KEY (hash, options));
+"""
+
+# Formats Pillow can write back in the same format, so file names and media types stay as they were
+SHRINKABLE_FORMATS = {"JPEG", "PNG", "GIF", "WEBP"}
+DEFAULT_QUALITY = 80
+
+
+def pillow_available() -> bool:
+    return importlib.util.find_spec("PIL") is not None
+
+
+@dataclass(frozen=True, slots=True)
+class ShrinkOptions:
+    max_dimension: int | None = None
+    quality: int = DEFAULT_QUALITY
+    first_frame: bool = False
+
+    @property
+    def key(self) -> str:
+        return f"{self.max_dimension}:{self.quality}:{int(self.first_frame)}"
+
+
+def shrink_image(data: bytes, options: ShrinkOptions) -> bytes:
+    # re-encodes in the original format; anything Pillow can't read, or that doesn't get smaller, is kept as is
+    from PIL import Image, UnidentifiedImageError
+
+    try:
+        image = Image.open(io.BytesIO(data))
+        image_format = image.format
+        if image_format not in SHRINKABLE_FORMATS:
+            return data
+        animated = getattr(image, "is_animated", False)
+        if animated and not options.first_frame:
+            # dropping the other frames changes the picture, only done when asked for
+            return data
+        image.seek(0)
+        image.load()
+    except (UnidentifiedImageError, OSError, ValueError):
+        return data
+
+    if options.max_dimension and max(image.size) > options.max_dimension:
+        image.thumbnail((options.max_dimension, options.max_dimension))
+    if image_format == "JPEG" and image.mode not in ("RGB", "L", "CMYK"):
+        image = image.convert("RGB")
+
+    out = io.BytesIO()
+    if image_format in ("JPEG", "WEBP"):
+        image.save(out, image_format, quality=options.quality, optimize=True)
+    else:
+        image.save(out, image_format, optimize=True)
+    shrunk = out.getvalue()
+    return shrunk if len(shrunk) < len(data) else data
+
+
+class ShrinkCache:
+    # Shrunk images keyed by the hash of the original and the options used, so rebuilding a book
+    # doesn't re-encode anything
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._db.executescript(SCHEMA)
+        self._db.commit()
+
+    def get(self, digest: str, options: ShrinkOptions) -> bytes | None:
+        with self._lock:
+            row = self._db.execute("SELECT data FROM shrunk WHERE hash=? AND options=?",
+                                   (digest, options.key)).fetchone()
+        return row[0] if row else None
+
+    def put(self, digest: str, options: ShrinkOptions, data: bytes):
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO shrunk (hash, options, data) VALUES (?, ?, ?)",
+                             (digest, options.key, data))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+async def _single_chunk(data: bytes):
+    yield data
+
+
+class ImageShrinker:
+    # Optional stage between fetching an image and writing it to the book: re-encodes, downscales and
+    # flattens animated gifs. Images keep the name given by the hash of the original, so books stay
+    # deduplicated, resumable and updatable the same way; only the bytes written change.
+    # The encoding runs on `executor`, anything with an async run(fn, *args) like the Transformer of the pages,
+    # so both share the same processes; inline when there is none.
+
+    def __init__(self, options: ShrinkOptions, spool: ImageSpool, cache: ShrinkCache | None = None, executor=None):
+        self.options = options
+        self.spool = spool
+        self.cache = cache
+        self.executor = executor
+        self.before = 0
+        self.after = 0
+
+    async def shrink(self, source) -> SpooledImage:
+        # source is anything with hash, read() and release(), like a SpooledImage; it is released once shrunk
+        shrunk = None
+        if self.cache is not None:
+            shrunk = await asyncio.to_thread(self.cache.get, source.hash, self.options)
+        if shrunk is None:
+            data = await asyncio.to_thread(source.read)
+            if self.executor is None:
+                shrunk = shrink_image(data, self.options)
+            else:
+                shrunk = await self.executor.run(shrink_image, data, self.options)
+            if self.cache is not None:
+                await asyncio.to_thread(self.cache.put, source.hash, self.options, shrunk)
+        self.before += source.size
+        self.after += len(shrunk)
+        source.release()
+        # back through the spool, so shrunk images count against the same memory budget
+        return await self.spool.store(_single_chunk(shrunk))
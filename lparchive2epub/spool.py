@@ -0,0 +1,101 @@
+import io
+import os
+import tempfile
+import threading
+from hashlib import blake2b
+from typing import AsyncIterable, BinaryIO
+
+# Image bytes kept in memory across the whole run before new images spill to the spool directory
+DEFAULT_MEMORY_BUDGET = 64 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+
+
+class SpooledImage:
+
+    def __init__(self, spool: "ImageSpool", digest: str, size: int, data: bytes | None = None, path: str | None = None):
+        self.spool = spool
+        self.hash = digest
+        self.size = size
+        self.data = data
+        self.path = path
+
+    def open(self) -> BinaryIO:
+        if self.path is not None:
+            return open(self.path, "rb")
+        return io.BytesIO(self.data or b"")
+
+    def read(self) -> bytes:
+        with self.open() as f:
+            return f.read()
+
+    def release(self):
+        self.spool.release(self)
+
+
+class ImageSpool:
+    # Receives image bodies chunk by chunk, hashing as they arrive. Bodies stay in memory while the
+    # run-wide budget allows it, anything beyond goes to a file in a temporary spool directory.
+    # Images are released from the book writer thread, so the budget is only changed under a lock.
+
+    def __init__(self, memory_budget: int = DEFAULT_MEMORY_BUDGET, directory: str | None = None):
+        self.memory_budget = memory_budget
+        self.in_memory = 0
+        self.spilled = 0
+        self._lock = threading.Lock()
+        self._dir = tempfile.TemporaryDirectory(prefix="lparchive2epub-", dir=directory)
+
+    @property
+    def directory(self) -> str:
+        return self._dir.name
+
+    async def store(self, chunks: AsyncIterable[bytes]) -> SpooledImage:
+        hasher = blake2b()
+        buffered: list[bytes] = []
+        buffered_size = 0
+        size = 0
+        fd, path = None, None
+        try:
+            async for chunk in chunks:
+                hasher.update(chunk)
+                size += len(chunk)
+                if fd is None and self.in_memory + len(chunk) > self.memory_budget:
+                    # a file per image, even when another url has the same bytes, so releasing one keeps the other
+                    fd, path = tempfile.mkstemp(dir=self.directory)
+                    for b in buffered:
+                        os.write(fd, b)
+                    with self._lock:
+                        self.in_memory -= buffered_size
+                    buffered, buffered_size = [], 0
+                if fd is None:
+                    buffered.append(chunk)
+                    buffered_size += len(chunk)
+                    with self._lock:
+                        self.in_memory += len(chunk)
+                else:
+                    os.write(fd, chunk)
+        except BaseException:
+            with self._lock:
+                self.in_memory -= buffered_size
+            if fd is not None:
+                os.close(fd)
+                os.remove(path)
+            raise
+
+        digest = hasher.hexdigest()
+        if fd is None:
+            return SpooledImage(self, digest, size, data=b"".join(buffered))
+        os.close(fd)
+        self.spilled += 1
+        return SpooledImage(self, digest, size, path=path)
+
+    def release(self, image: SpooledImage):
+        if image.data is not None:
+            with self._lock:
+                self.in_memory -= image.size
+            image.data = None
+        elif image.path is not None:
+            os.remove(image.path)
+            image.path = None
+
+    def close(self):
+        self._dir.cleanup()
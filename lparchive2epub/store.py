@@ -0,0 +1,69 @@
+import io
+import sqlite3
+import threading
+from typing import BinaryIO
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, hash TEXT);
+CREATE TABLE IF NOT EXISTS blobs (hash TEXT PRIMARY KEY, size INTEGER, data BLOB);
+"""
+
+
+class StoredImage:
+    # Same reading interface as a SpooledImage, read from the store when the zip entry is written
+
+    def __init__(self, store: "ImageStore", digest: str, size: int):
+        self.store = store
+        self.hash = digest
+        self.size = size
+
+    def open(self) -> BinaryIO:
+        return io.BytesIO(self.read())
+
+    def read(self) -> bytes:
+        return self.store.image_data(self.hash)
+
+    def release(self):
+        pass
+
+
+class ImageStore:
+    # Image bytes shared by every conversion, keyed by url and stored once per blake2b hash, so the banners
+    # and smilies many let's plays have in common are only downloaded once across a whole archive mirror.
+    # Several processes can use the same file.
+
+    def __init__(self, path: str):
+        self.path = path
+        self.hits = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(SCHEMA)
+        self._db.commit()
+
+    def lookup(self, url: str) -> StoredImage | None:
+        with self._lock:
+            row = self._db.execute("SELECT b.hash, b.size FROM urls u JOIN blobs b ON b.hash = u.hash WHERE u.url=?",
+                                   (url,)).fetchone()
+        if row is None:
+            return None
+        self.hits += 1
+        return StoredImage(self, row[0], row[1])
+
+    def put(self, url: str, image) -> StoredImage:
+        # image is anything with hash, size and read(), like a SpooledImage
+        with self._lock, self._db:
+            known = self._db.execute("SELECT 1 FROM blobs WHERE hash=?", (image.hash,)).fetchone()
+            if not known:
+                self._db.execute("INSERT OR IGNORE INTO blobs (hash, size, data) VALUES (?, ?, ?)",
+                                 (image.hash, image.size, image.read()))
+            self._db.execute("INSERT OR REPLACE INTO urls (url, hash) VALUES (?, ?)", (url, image.hash))
+        return StoredImage(self, image.hash, image.size)
+
+    def image_data(self, digest: str) -> bytes:
+        with self._lock:
+            return self._db.execute("SELECT data FROM blobs WHERE hash=?", (digest,)).fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,187 @@
+import asyncio
+import datetime
+import os
+import shutil
+import zipfile
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, BinaryIO, Callable, Dict
+
+from ebooklib import epub
+from ebooklib.epub import EpubBook, EpubImage, EpubItem, EpubNav, EpubNcx
+
+from lparchive2epub.spool import CHUNK_SIZE, SpooledImage
+
+# How far ahead of the next chapter to write the page workers are allowed to run
+REORDER_WINDOW = 50
+# Formats that are compressed already, deflating them again costs time for a few bytes at best
+STORED_MEDIA_TYPES = frozenset({"image/jpeg", "image/png", "image/gif", "image/webp"})
+
+
+class _DeterministicZip:
+    # Every entry gets the same timestamp and permissions so identical books hash identically.
+
+    def __init__(self, file: str, date_time: tuple, compresslevel: int):
+        self.zip = zipfile.ZipFile(file, "w", zipfile.ZIP_DEFLATED, compresslevel=compresslevel)
+        self.date_time = date_time
+        self.compresslevel = compresslevel
+
+    def writestr(self, name: str, data, compress_type: int = zipfile.ZIP_DEFLATED):
+        info = zipfile.ZipInfo(name, date_time=self.date_time)
+        info.compress_type = compress_type
+        info.external_attr = 0o644 << 16
+        self.zip.writestr(info, data, compresslevel=self.compresslevel)
+
+    def write_stream(self, name: str, source: BinaryIO, size: int, compress_type: int = zipfile.ZIP_DEFLATED):
+        info = zipfile.ZipInfo(name, date_time=self.date_time)
+        info.compress_type = compress_type
+        info.external_attr = 0o644 << 16
+        info.file_size = size
+        with self.zip.open(info, "w") as dest:
+            shutil.copyfileobj(source, dest, CHUNK_SIZE)
+
+    def close(self):
+        self.zip.close()
+
+
+class StreamingEpubWriter(epub.EpubWriter):
+    # Writes items to the zip as soon as they are handed over and drops their content afterwards;
+    # navigation, ncx and the package document are written by finish() once the whole book is known.
+    # The book is assembled in "<name>.part" and only moved to <name> when complete.
+    # Entries are serialized and deflated on a single writer thread, in the order they were handed over, so the
+    # compression runs alongside downloads and page parsing instead of on the event loop.
+
+    def __init__(self, name: str, book: EpubBook, options: Dict[str, Any] | None = None):
+        # the epub3 page list is built by re-parsing every chapter, which are long gone by the time nav is written.
+        # lparchive updates carry no pagebreak markers, so it would be empty anyway.
+        super().__init__(name, book, {"epub3_pages": False, **(options or {})})
+        self.part_name = f"{name}.part"
+        mtime = self.options.get("mtime", datetime.datetime(1980, 1, 1))
+        self.out = _DeterministicZip(self.part_name, mtime.timetuple()[:6], self.options["compresslevel"])
+        self._written: set[str] = set()
+        self._thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix="epub-writer")
+        self._pending: list[Future] = []
+        self.out.writestr("mimetype", "application/epub+zip", compress_type=zipfile.ZIP_STORED)
+        self._write_container()
+
+    def _path(self, item: EpubItem) -> str:
+        if item.manifest:
+            return f"{self.book.FOLDER_NAME}/{item.file_name}"
+        return item.file_name
+
+    def _submit(self, fn: Callable, *args):
+        # a failed write is raised when the next entry is handed over, or by finish()
+        for f in self._pending:
+            if f.done():
+                f.result()
+        self._pending = [f for f in self._pending if not f.done()]
+        self._pending.append(self._thread.submit(fn, *args))
+
+    def drain(self):
+        # waits for every entry handed over so far to be in the zip
+        pending, self._pending = self._pending, []
+        for f in pending:
+            f.result()
+
+    def write_item(self, item: EpubItem):
+        if item.file_name in self._written:
+            return
+        self._written.add(item.file_name)
+        self._submit(self._write_item, item)
+
+    def _write_item(self, item: EpubItem):
+        compress_type = zipfile.ZIP_STORED if item.media_type in STORED_MEDIA_TYPES else zipfile.ZIP_DEFLATED
+        if isinstance(item, SpooledEpubImage):
+            with item.source.open() as f:
+                self.out.write_stream(self._path(item), f, item.source.size, compress_type)
+            release(item)
+            return
+        if isinstance(item, EpubNcx):
+            content = self._get_ncx()
+        elif isinstance(item, EpubNav):
+            content = self._get_nav(item)
+        else:
+            content = item.get_content()
+        self.out.writestr(self._path(item), content, compress_type)
+        release(item)
+
+    def release_item(self, item: EpubItem):
+        # queued behind the writes already handed over, one of them may be this very image
+        self._submit(release, item)
+
+    def write_file(self, name: str, data):
+        # files outside the manifest, like the chapter list kept for later updates
+        self._submit(self.out.writestr, name, data)
+
+    def finish(self):
+        for item in self.book.get_items():
+            self.write_item(item)
+        self.drain()
+        self._thread.shutdown()
+        self._write_opf()
+        self.out.close()
+        os.replace(self.part_name, self.file_name)
+
+    def abort(self):
+        self._thread.shutdown(cancel_futures=True)
+        self._pending = []
+        self.out.close()
+        if os.path.exists(self.part_name):
+            os.remove(self.part_name)
+
+
+class SpooledEpubImage(EpubImage):
+    # An image whose bytes stay in the spool until the zip entry is written
+
+    def __init__(self, uid: str, file_name: str, media_type: str, source: SpooledImage):
+        super().__init__(uid=uid, file_name=file_name, media_type=media_type)
+        self.source = source
+
+    def get_content(self, default=b""):
+        return self.source.read()
+
+
+class PrebuiltEpubHtml(epub.EpubHtml):
+    # A chapter taken as is from a previously written book
+
+    def __init__(self, xhtml: bytes, **kwargs):
+        super().__init__(**kwargs)
+        self.content = xhtml
+
+    def get_content(self, default=None):
+        return self.content
+
+
+def release(item: EpubItem):
+    # the item stays in the book for the manifest, spine and toc; only its payload goes away
+    if isinstance(item, SpooledEpubImage):
+        item.source.release()
+    elif not isinstance(item, (EpubNcx, EpubNav)):
+        item.content = b""
+
+
+class ReorderBuffer:
+    # Hands items to `flush` strictly in key order, whatever order they complete in.
+    # reserve() makes producers wait while they are more than `window` keys ahead of the next key to flush,
+    # which bounds how many finished-but-unwritten items can pile up.
+
+    def __init__(self, flush: Callable[[Any], None], first: int = 0, window: int = REORDER_WINDOW):
+        self.flush = flush
+        self.next = first
+        self.window = window
+        self._pending: Dict[int, Any] = {}
+        self._condition = asyncio.Condition()
+
+    async def reserve(self, key: int):
+        async with self._condition:
+            await self._condition.wait_for(lambda: key < self.next + self.window)
+
+    async def push(self, key: int, item: Any):
+        async with self._condition:
+            self._pending[key] = item
+            while self.next in self._pending:
+                self.flush(self._pending.pop(self.next))
+                self.next += 1
+            self._condition.notify_all()
+
+    def __len__(self):
+        return len(self._pending)
@@ -1,7 +1,16 @@
+from collections import Counter
 from importlib.resources import files
 import json
 import random
+
+import aiohttp
 import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from lparchive2epub.lib import lparchive2epub
+
+CHAPTERS = 6
 
 
 def pytest_addoption(parser):
@@ -31,3 +40,98 @@ def pytest_generate_tests(metafunc):
     else:
         if "lp" in metafunc.fixturenames and "b3sum" in metafunc.fixturenames:
             metafunc.parametrize(("lp", "b3sum"), [(None, None)])
+
+
+def png(n: int) -> bytes:
+    return b"\x89PNG\r\n\x1a\n" + bytes([n]) * (64 + n)
+
+
+def front_page(lps: list[str]) -> str:
+    # the let's plays are listed in the 14th script, like on lparchive
+    toc = ",".join(f"{{'u':'/{x}','t':'{x}'}}" for x in lps)
+    return "<html><body>" + "<script></script>" * 13 + f"<script>var tocdata=[{toc}];</script></body></html>"
+
+
+def landing_page(chapters: int) -> str:
+    links = "".join(f'<li><a href="Update%20{i}/">Part {i}</a></li>' for i in range(1, chapters + 1))
+    return f"""<html><head><title>Fake LP</title><meta name="author" content="Someone"></head>
+<body><div id="content"><p>Welcome <img src="../img/banner.png"></p><ul>{links}</ul></div>
+<ul><li id="archival">Archived on <strong>Jan 02, 2020</strong></li></ul></body></html>"""
+
+
+def update_page(n: int, chapters: int, repeated_images: bool, dead_images: bool) -> str:
+    extra = ""
+    if repeated_images:
+        extra += f'<img src="../../img/shot{n}.png"><a href="../../img/shot{n}.png">again</a>'
+    if dead_images:
+        extra += f'<img src="../../img/gone{n}.png">'
+    return f"""<html><head><title>Part {n}</title></head><body><div id="content">
+<p>Part <st1:place>{n}</st1:place><o:p></o:p> <img src="../../img/banner.png"></p>
+<img src="../../img/shot{n}.png"><a href="../../img/full{n}.png">full size</a>{extra}
+<a href="../Update%20{n % chapters + 1}/">next</a>
+</div></body></html>"""
+
+
+class FakeLparchive:
+    # A let's play served locally. Every update shows the banner of the landing page, a screenshot and a link to
+    # its full size version. Tests change the attributes while the server runs, like publishing new updates.
+
+    def __init__(self):
+        self.hits = Counter()
+        # answered with a 500
+        self.broken: set[str] = set()
+        self.chapters = CHAPTERS
+        # every update shows its screenshot twice more, and an image that doesn't exist anymore
+        self.repeated_images = False
+        self.dead_images = False
+        # served the same way, and listed on the front page
+        self.lps = ["Fake-LP"]
+        # client end of every connection used
+        self.peers: set = set()
+        app = web.Application()
+        app.router.add_get("/{tail:.*}", self.handle)
+        self.server = TestServer(app)
+
+    async def __aenter__(self):
+        await self.server.start_server()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.server.close()
+
+    def url(self, path: str = "/Fake-LP") -> str:
+        return str(self.server.make_url(path))
+
+    async def handle(self, request: web.Request):
+        path = request.path
+        self.hits[path] += 1
+        self.peers.add(request.transport.get_extra_info("peername"))
+        if path in self.broken:
+            return web.Response(status=500)
+        lp = path.split("/")[1]
+        if path == "/":
+            return web.Response(text=front_page(self.lps), content_type="text/html")
+        if lp in self.lps and path.rstrip("/") == f"/{lp}":
+            return web.Response(text=landing_page(self.chapters), content_type="text/html")
+        if lp in self.lps and path.startswith(f"/{lp}/Update "):
+            n = int(path.split(" ")[1].strip("/"))
+            page = update_page(n, self.chapters, self.repeated_images, self.dead_images)
+            return web.Response(text=page, content_type="text/html")
+        if path == "/img/banner.png":
+            return web.Response(body=png(0), content_type="image/png")
+        if path.startswith("/img/shot"):
+            return web.Response(body=png(int(path[len("/img/shot"):-4])), content_type="image/png")
+        if path.startswith("/img/full"):
+            return web.Response(body=png(100 + int(path[len("/img/full"):-4])), content_type="image/png")
+        return web.Response(status=404)
+
+    async def build(self, path, root_session=None, **kwargs):
+        # pages are transformed inline unless a test asks for the process pool
+        kwargs.setdefault("transform_workers", 0)
+        kwargs.setdefault("writer", lambda *_: None)
+        await lparchive2epub(self.url(), str(path), root_session or aiohttp.ClientSession(), **kwargs)
+
+
+@pytest.fixture
+def lparchive() -> FakeLparchive:
+    return FakeLparchive()
@@ -0,0 +1,80 @@
+import asyncio
+import functools
+import json
+import os
+import queue
+import sqlite3
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from lparchive2epub.jobs import JobQueue
+from lparchive2epub.limiter import CircuitBreaker, RateLimit
+from util import all_archives
+
+
+@pytest.mark.asyncio
+async def test_a_lost_lease_stops_the_conversion(tmp_path, monkeypatch):
+    path = str(tmp_path / "jobs.sqlite")
+    jobs = JobQueue(path)
+    jobs.add(["/LP"])
+    jobs.close()
+    monkeypatch.setattr(all_archives, "JobQueue", functools.partial(JobQueue, lease=0.15))
+    cancelled = asyncio.Event()
+
+    async def stolen_conversion(*_):
+        # another node took the job over
+        db = sqlite3.connect(path)
+        with db:
+            db.execute("UPDATE jobs SET worker='other', lease_until=?", (time.time() + 60,))
+        db.close()
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    monkeypatch.setattr(all_archives, "convert", stolen_conversion)
+    results = queue.Queue()
+    arguments = SimpleNamespace(output=[str(tmp_path)], jobs=path)
+    current = SimpleNamespace(value=b"")
+    await all_archives.work(arguments, str(tmp_path), str(tmp_path / "images.sqlite"), RateLimit(10),
+                            CircuitBreaker("lparchive.org"), None, results, current)
+
+    assert cancelled.is_set()
+    assert list(results.queue) == [("/LP", all_archives.LEASE_LOST)]
+    assert current.value == b""
+    jobs = JobQueue(path)
+    # left to the other worker, neither done nor failed
+    assert jobs.counts() == {"leased": 1}
+    jobs.close()
+
+
+def dying_worker(*args):
+    # runs in the spawned worker: the one that gets Doomed-LP dies on it, without reporting anything
+    do_single = all_archives.do_single
+
+    async def dying_do_single(arguments, url, *rest):
+        if url == "/Doomed-LP":
+            os._exit(3)
+        return await do_single(arguments, url, *rest)
+
+    all_archives.do_single = dying_do_single
+    all_archives.worker(*args)
+
+
+@pytest.mark.asyncio
+async def test_a_dead_worker_does_not_stop_the_run(tmp_path, monkeypatch, lparchive):
+    lparchive.lps = ["Fake-LP", "Doomed-LP", "Other-LP", "Last-LP"]
+    lparchive.chapters = 2
+    monkeypatch.setattr(all_archives, "worker", dying_worker)
+    async with lparchive:
+        arguments = SimpleNamespace(output=[str(tmp_path)], cache_path=None, processes=2, rate=1000.0, jobs=None,
+                                    retry_failed=False, force=False, revalidate=False, image_store=None,
+                                    site=lparchive.url("").rstrip("/"))
+        await all_archives.do(arguments)
+
+    assert sorted(x.name for x in tmp_path.glob("*.epub")) == ["Fake-LP.epub", "Last-LP.epub", "Other-LP.epub"]
+    [failure] = json.loads((tmp_path / "failures.json").read_text())
+    assert (failure["url"], failure["error"], failure["message"]) == ("/Doomed-LP", "WorkerDied", "exit code 3")
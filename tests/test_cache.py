@@ -0,0 +1,136 @@
+import pickle
+import socket
+import sqlite3
+from collections import Counter
+from types import SimpleNamespace
+
+import aiohttp
+import pytest
+from aiohttp import web
+from aiohttp.abc import AbstractResolver
+from aiohttp.test_utils import TestServer
+from aiohttp_client_cache import CachedSession, SQLiteBackend
+
+from lparchive2epub.cache import CACHE_FILE_NAME, PersistentCache, is_landing_page
+from lparchive2epub.compression import MAGIC, CompressingSerializer
+
+
+@pytest.mark.asyncio
+async def test_persistent_cache_survives_runs(tmp_path, lparchive):
+    hits = lparchive.hits
+    async with lparchive:
+        first = PersistentCache(str(tmp_path / "cache"))
+        await lparchive.build(tmp_path / "a.epub", root_session=CachedSession(cache=first))
+        assert first.hits == 0
+        assert first.misses > 0
+
+        second = PersistentCache(str(tmp_path / "cache"))
+        await lparchive.build(tmp_path / "b.epub", root_session=CachedSession(cache=second))
+
+    assert all(v == 1 for v in hits.values())
+    assert second.misses == 0
+    assert second.hit_ratio == 1
+    assert (tmp_path / "a.epub").read_bytes() == (tmp_path / "b.epub").read_bytes()
+
+
+@pytest.mark.asyncio
+async def test_persistent_cache_evicts_least_recently_used(tmp_path, lparchive):
+    async with lparchive:
+        cache = PersistentCache(str(tmp_path / "cache"), max_size=4096)
+        await lparchive.build(tmp_path / "a.epub", root_session=CachedSession(cache=cache))
+
+    assert cache.evicted > 0
+    assert cache._size <= 4096
+    assert "evicted" in cache.report()
+
+
+def test_landing_pages_are_not_cached():
+    def response(url):
+        return SimpleNamespace(url=url)
+
+    assert is_landing_page(response("https://lparchive.org/Resident-Evil-1"))
+    assert is_landing_page(response("https://lparchive.org/Resident-Evil-1/"))
+    assert not is_landing_page(response("https://lparchive.org/Resident-Evil-1/Update%201/"))
+    assert not is_landing_page(response("https://i.imgur.com/abcdef.png"))
+
+
+class LocalResolver(AbstractResolver):
+    # lparchive.org is this machine, so the cache sees the real host name
+
+    async def resolve(self, host, port=0, family=socket.AF_INET):
+        return [{"hostname": host, "host": "127.0.0.1", "port": port, "family": socket.AF_INET, "proto": 0,
+                 "flags": socket.AI_NUMERICHOST}]
+
+    async def close(self):
+        pass
+
+
+@pytest.mark.asyncio
+async def test_revalidated_pages_cost_a_304_and_pick_up_edits(tmp_path):
+    statuses = Counter()
+    version = ["1"]
+
+    async def handle(request: web.Request):
+        etag = f'"{request.path}-{version[0]}"'
+        if request.headers.get("If-None-Match") == etag:
+            statuses[request.path, 304] += 1
+            return web.Response(status=304, headers={"ETag": etag})
+        statuses[request.path, 200] += 1
+        return web.Response(text=f"{request.path} v{version[0]}", headers={"ETag": etag})
+
+    app = web.Application()
+    app.router.add_get("/{tail:.*}", handle)
+    cache = PersistentCache(str(tmp_path / "cache"), revalidate_pages=True)
+
+    async def get(path):
+        async with session.get(f"http://lparchive.org:{server.port}{path}") as r:
+            return await r.text()
+
+    connector = aiohttp.TCPConnector(resolver=LocalResolver())
+    async with TestServer(app) as server, CachedSession(cache=cache, connector=connector) as session:
+        for path in ["/Fake-LP", "/Fake-LP/Update%201/", "/Fake-LP/Update%201/shot.png"]:
+            assert await get(path) == await get(path)
+        version[0] = "2"
+        assert await get("/Fake-LP/Update%201/") == "/Fake-LP/Update 1/ v2"
+        assert await get("/Fake-LP/Update%201/shot.png") == "/Fake-LP/Update 1/shot.png v1"
+
+    # pages, the landing page included, are checked on every use; images are never asked for again
+    assert statuses["/Fake-LP", 200] == 1 and statuses["/Fake-LP", 304] == 1
+    assert statuses["/Fake-LP/Update 1/", 200] == 2 and statuses["/Fake-LP/Update 1/", 304] == 1
+    assert statuses["/Fake-LP/Update 1/shot.png", 200] == 1 and statuses["/Fake-LP/Update 1/shot.png", 304] == 0
+
+
+@pytest.mark.asyncio
+async def test_pages_are_stored_compressed_and_plain_caches_stay_readable(tmp_path, lparchive):
+    hits = lparchive.hits
+    async with lparchive:
+        plain = SQLiteBackend(str(tmp_path / "plain" / CACHE_FILE_NAME), autoclose=False)
+        await lparchive.build(tmp_path / "a.epub", root_session=CachedSession(cache=plain))
+        await plain.close()
+        hits.clear()
+        # a cache written before pages were compressed
+        legacy = PersistentCache(str(tmp_path / "plain"))
+        await lparchive.build(tmp_path / "b.epub", root_session=CachedSession(cache=legacy))
+        assert not any(k.startswith(("/img/", "/Fake-LP/Update")) for k in hits)
+
+        cache = PersistentCache(str(tmp_path / "compressed"))
+        await lparchive.build(tmp_path / "c.epub", root_session=CachedSession(cache=cache))
+
+    with sqlite3.connect(tmp_path / "compressed" / CACHE_FILE_NAME) as db:
+        values = [bytes(x) for x, in db.execute("SELECT value FROM responses")]
+    pages = [x for x in values if x.startswith(MAGIC)]
+    # the fake landing page isn't on lparchive.org, so it is cached too
+    assert len(pages) == 1 + lparchive.chapters
+    # images are compressed already
+    assert all(pickle.loads(x).content_type == "image/png" for x in values if not x.startswith(MAGIC))
+    assert (tmp_path / "a.epub").read_bytes() == (tmp_path / "b.epub").read_bytes() == \
+           (tmp_path / "c.epub").read_bytes()
+
+
+def test_entries_from_another_dictionary_are_misses():
+    response = SimpleNamespace(content_type="text/html", body="<html></html>" * 100)
+    data = CompressingSerializer(b"<html>old</html>").dumps(response)
+    assert len(data) < len(pickle.dumps(response))
+    assert CompressingSerializer(b"<html>old</html>").loads(data) == response
+    with pytest.raises(pickle.PickleError):
+        CompressingSerializer(b"<html>new</html>").loads(data)
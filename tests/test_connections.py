@@ -0,0 +1,49 @@
+import time
+
+import pytest
+from aiohttp_client_cache import CacheBackend
+
+from lparchive2epub.connections import ConnectionPool
+from lparchive2epub.lib import get_resource_with_retries
+from lparchive2epub.limiter import PerHostLimiter, RateLimit
+
+
+@pytest.mark.asyncio
+async def test_conversions_share_kept_alive_connections(tmp_path, lparchive):
+    peers = lparchive.peers
+    async with lparchive, ConnectionPool(limit_per_host=4) as pool:
+        await lparchive.build(tmp_path / "first.epub", pool.session(CacheBackend()))
+        first = set(peers)
+        # the first conversion closed its session, not the pool
+        assert not pool.connector.closed
+        await lparchive.build(tmp_path / "second.epub", pool.session(CacheBackend()))
+
+    assert len(first) <= 4
+    assert peers == first
+    assert (tmp_path / "first.epub").read_bytes() == (tmp_path / "second.epub").read_bytes()
+
+
+@pytest.mark.asyncio
+async def test_cache_hits_do_not_wait_for_the_rate_limit(lparchive):
+    hits = lparchive.hits
+    limiter = PerHostLimiter(rate_limit=RateLimit(5))
+    async with lparchive, ConnectionPool() as pool:
+        url = lparchive.url()
+        async with pool.session(CacheBackend()) as session:
+            await get_resource_with_retries(session, url, limiter=limiter)
+            started = time.monotonic()
+            for _ in range(10):
+                await get_resource_with_retries(session, url, limiter=limiter)
+            cached = time.monotonic() - started
+        # without the cache, every request waits for its turn
+        async with pool.session() as session:
+            started = time.monotonic()
+            for _ in range(3):
+                await get_resource_with_retries(session, url, limiter=limiter)
+            sent = time.monotonic() - started
+
+    assert hits["/Fake-LP"] == 4
+    # only what reached the server adjusts the window
+    assert limiter.metrics()[0].requests == 4
+    assert cached < 0.1
+    assert sent >= 2 * 0.2 * 0.9
@@ -0,0 +1,53 @@
+import time
+
+from lparchive2epub.jobs import JobQueue
+
+
+def test_jobs_are_leased_once_and_finished(tmp_path):
+    path = str(tmp_path / "jobs.sqlite")
+    first = JobQueue(path)
+    second = JobQueue(path)
+    assert first.add(["/A", "/B", "/C"]) == 3
+    assert second.add(["/A", "/B", "/C", "/D"]) == 1
+
+    leased = [first.lease("w1"), second.lease("w2"), first.lease("w1"), second.lease("w2")]
+    assert sorted(leased) == ["/A", "/B", "/C", "/D"]
+    assert first.lease("w1") is None
+
+    first.done(leased[0], "w1")
+    second.fail(leased[1], "w2", "Traceback...\nRuntimeError: boom")
+    assert first.counts() == {"done": 1, "failed": 1, "leased": 2}
+    [failure] = first.failures()
+    assert (failure.url, failure.worker, failure.attempts) == (leased[1], "w2", 1)
+
+    assert first.retry_failed() == 1
+    assert second.lease("w3") == leased[1]
+    # a released job is pending again, and the interrupted attempt doesn't count
+    second.release(leased[1], "w3")
+    assert first.requeues(leased[1]) == 1
+    assert first.lease("w4") == leased[1]
+    first.fail(leased[1], "w4", "boom")
+    assert first.failures()[0].attempts == 2
+    # tried again from scratch, interruptions included
+    assert first.retry_failed() == 1
+    assert first.requeues(leased[1]) == 0
+    first.close()
+    second.close()
+
+
+def test_expired_leases_go_back_to_other_workers(tmp_path):
+    jobs = JobQueue(str(tmp_path / "jobs.sqlite"), lease=0.05)
+    jobs.add(["/A"])
+    assert jobs.lease("crashed") == "/A"
+    assert jobs.lease("other") is None
+    time.sleep(0.1)
+
+    assert jobs.lease("other") == "/A"
+    # the first worker lost the job, its heartbeat and result are ignored
+    assert not jobs.heartbeat("/A", "crashed")
+    jobs.done("/A", "crashed")
+    assert jobs.counts() == {"leased": 1}
+    assert jobs.heartbeat("/A", "other")
+    jobs.done("/A", "other")
+    assert jobs.counts() == {"done": 1}
+    jobs.close()
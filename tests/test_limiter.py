@@ -0,0 +1,161 @@
+import asyncio
+import time
+from contextlib import nullcontext
+
+import aiohttp
+import pytest
+
+from lparchive2epub.limiter import AimdLimiter, CircuitBreaker, PerHostLimiter, RateLimit
+
+
+async def run_request(limiter: AimdLimiter, status: int | None = 200, error: Exception | None = None):
+    with pytest.raises(type(error)) if error else nullcontext():
+        async with limiter.slot() as slot:
+            slot.status = status
+            if error:
+                raise error
+
+
+@pytest.mark.asyncio
+async def test_aimd_grows_on_healthy_responses():
+    limiter = AimdLimiter("lparchive.org", initial=2, maximum=8)
+    for _ in range(20):
+        await run_request(limiter)
+    assert limiter.window > 2
+    assert limiter.window <= 8
+    metrics = limiter.metrics()
+    assert metrics.increases > 0
+    assert metrics.requests == 20
+    assert all(d.action == "increase" for d in metrics.decisions)
+
+
+@pytest.mark.asyncio
+async def test_aimd_backs_off_on_throttling_and_timeouts():
+    limiter = AimdLimiter("lparchive.org", initial=8, minimum=1)
+    await run_request(limiter, status=429)
+    assert limiter.window == 4
+    await run_request(limiter, error=asyncio.TimeoutError())
+    assert limiter.window == 2
+    await run_request(limiter, status=503)
+    await run_request(limiter, status=503)
+    assert limiter.window == 1
+    assert limiter.metrics().decreases == 3
+    assert [d.action for d in limiter.metrics().decisions] == ["decrease"] * 3
+
+
+@pytest.mark.asyncio
+async def test_aimd_ignores_non_congestion_failures():
+    limiter = AimdLimiter("lparchive.org", initial=4)
+    await run_request(limiter, status=404)
+    await run_request(limiter, error=ValueError("bad page"))
+    assert limiter.window == 4
+    assert limiter.metrics().decreases == 0
+
+
+@pytest.mark.asyncio
+async def test_aimd_single_decrease_per_congestion_event():
+    limiter = AimdLimiter("lparchive.org", initial=8)
+    started = [await limiter.acquire() for _ in range(4)]
+    for s in started:
+        await limiter.release(s, status=503)
+    assert limiter.window == 4
+    assert limiter.in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_aimd_window_bounds_in_flight():
+    limiter = AimdLimiter("lparchive.org", initial=3, maximum=3)
+    peak = 0
+
+    async def request():
+        nonlocal peak
+        async with limiter.slot() as slot:
+            peak = max(peak, limiter.in_flight)
+            await asyncio.sleep(0.01)
+            slot.status = 200
+
+    await asyncio.gather(*(request() for _ in range(12)))
+    assert peak == 3
+
+
+def test_per_host_limiter_splits_by_host():
+    limiter = PerHostLimiter(initial=2)
+    a = limiter.for_url("https://lparchive.org/Resident-Evil-1/Update%201/")
+    b = limiter.for_url("https://lparchive.org/X-COM-Terror-from-the-Deep/")
+    c = limiter.for_url("https://i.imgur.com/abc.png")
+    assert a is b
+    assert a is not c
+    assert sorted(m.host for m in limiter.metrics()) == ["i.imgur.com", "lparchive.org"]
+
+
+@pytest.mark.asyncio
+async def test_rate_limit_spaces_requests():
+    limiter = PerHostLimiter(rate_limit=RateLimit(50))
+    started = []
+
+    async def request():
+        async with limiter.slot("https://lparchive.org/LP/") as slot:
+            # what the session's network_trace does once the request goes to the network
+            await slot.sending()
+            started.append(time.monotonic())
+            slot.status = 200
+
+    await asyncio.gather(*(request() for _ in range(6)))
+    gaps = [b - a for a, b in zip(started, started[1:])]
+    assert min(gaps) >= 0.015
+    assert started[-1] - started[0] >= 5 * 0.02 * 0.9
+    # the wait isn't taken for latency
+    assert limiter.metrics()[0].holds == 0
+
+
+@pytest.mark.asyncio
+async def test_circuit_breaker_pauses_until_a_probe_gets_through():
+    breaker = CircuitBreaker("lparchive.org", threshold=3, pause=0.1)
+    limiter = PerHostLimiter(breaker=breaker)
+    assert breaker.covers("https://www.lparchive.org/LP/")
+    assert not breaker.covers("https://i.imgur.com/abc.png")
+
+    for _ in range(3):
+        with pytest.raises(aiohttp.ServerDisconnectedError):
+            async with limiter.slot("https://lparchive.org/LP/"):
+                raise aiohttp.ServerDisconnectedError()
+    assert not breaker.closed
+    assert breaker.trips == 1
+
+    # other hosts aren't held back
+    async with limiter.slot("https://i.imgur.com/abc.png") as slot:
+        slot.status = 200
+
+    started = time.monotonic()
+    entered = []
+
+    async def request(n):
+        async with limiter.slot("https://lparchive.org/LP/") as slot:
+            entered.append((n, time.monotonic() - started, breaker.closed))
+            await asyncio.sleep(0.05)
+            slot.status = 200
+
+    await asyncio.gather(*(request(n) for n in range(3)))
+    # a single probe after the pause, the others once it got its answer
+    assert entered[0][1] >= 0.09
+    assert not entered[0][2]
+    assert all(closed for _, _, closed in entered[1:])
+    assert breaker.closed
+    assert breaker.trips == 1
+
+
+@pytest.mark.asyncio
+async def test_cache_hits_are_left_out_of_the_window_and_the_breaker():
+    breaker = CircuitBreaker("lparchive.org", threshold=1, pause=0)
+    limiter = PerHostLimiter(breaker=breaker)
+    breaker.failure()
+    for sent in [False, True]:
+        async with limiter.slot("https://lparchive.org/LP/") as slot:
+            slot.status = 200
+            slot.from_cache = True
+            # a revalidated page comes from the cache too, but the request did go to lparchive
+            slot.sent = sent
+        # only the revalidation was an answer from lparchive to the probe
+        assert breaker.closed == sent
+    [metrics] = limiter.metrics()
+    assert metrics.requests == 1
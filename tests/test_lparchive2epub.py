@@ -1,4 +1,5 @@
-from lparchive2epub.lib import Extractor, Chapters, lparchive2epub, BeautifulSoup
+from lparchive2epub.lib import Extractor, Chapters, ChapterIndex, lparchive2epub, BeautifulSoup, PARSERS, \
+    get_cleaned_html, resolve_parser, CONTENT_ONLY, LANDING_METADATA
 from importlib.resources import files
 import tests.resources as resources
 import pytest
@@ -359,6 +360,63 @@ def test_all_images():
     images = Extractor.all_images(content, "https://lparchive.org/X-COM-Terror-from-the-Deep/")
     assert len(images) == 1
 
+def test_chapter_index_rewrites_links():
+    chapters = [Chapters(num=i, original_href=f"https://lparchive.org/LP/{slug}", txt=slug, new_href=f"update_{i}.xhtml",
+                         original_href_slug=slug)
+                for i, slug in enumerate(["Update%201/", "Update%2010/", "Update(2)/"])]
+    index = ChapterIndex(chapters)
+    assert index.rewrite("Update%201/") == "update_0.xhtml/"
+    assert index.rewrite("Update%2010/#top") == "update_1.xhtml/#top"
+    assert index.rewrite("Update(2)/") == "update_2.xhtml/"
+    assert index.rewrite("Update2/") == "Update2/"
+    asset = index.rewrite("Update%201/map.png")
+    assert asset.startswith("https://lparchive.org/LP/Update%201/") and asset.endswith("/map.png")
+    assert ChapterIndex([]).rewrite("Update%201/") == "Update%201/"
+
+
+def extracted(page: bytes, parser: str):
+    intro = Extractor.intro("https://lparchive.org/LP", get_cleaned_html(page, parser))
+    return (intro.title, intro.author, intro.published_on,
+            [(c.num, c.original_href, c.txt, c.new_href) for c in intro.chapters],
+            [(x.url, x.media_type) for x in intro.images],
+            " ".join(intro.intro.get_text().split()))
+
+
+@pytest.mark.parametrize("parser", [x for x in PARSERS if x != "html.parser"])
+@pytest.mark.parametrize("page", [re1, headshoots, xcom])
+def test_parsers_are_equivalent(page, parser):
+    if resolve_parser(parser) != parser:
+        pytest.skip(f"{parser} is not installed")
+    assert extracted(page, parser) == extracted(page, "html.parser")
+
+
+@pytest.mark.parametrize("page", [re1, headshoots, xcom])
+def test_restricted_parse_gives_the_same_intro(page):
+    full = Extractor.intro("https://lparchive.org/LP", get_cleaned_html(page))
+    restricted = Extractor.intro("https://lparchive.org/LP", get_cleaned_html(page, parse_only=CONTENT_ONLY),
+                                 BeautifulSoup(page, "html.parser", parse_only=LANDING_METADATA))
+    assert (restricted.title, restricted.author, restricted.published_on) == (full.title, full.author, full.published_on)
+    assert restricted.chapters == full.chapters
+    assert str(restricted.intro) == str(full.intro)
+
+
+def test_landing_metadata_keeps_only_what_the_intro_reads():
+    metadata = BeautifulSoup(headshoots, "html.parser", parse_only=LANDING_METADATA)
+    assert sorted({x.name for x in metadata.find_all(True)}) == ["li", "meta", "strong", "title"]
+    assert len(metadata.find_all("li")) == 1
+
+
+def test_cleaning_unwraps_nested_tags():
+    page = ("<p>To <st1:place><st1:city>Town</st1:city>, <st1:state>State</st1:state></st1:place><o:p></o:p></p>"
+            "<p><o:p><st1:placename>Far</st1:placename></o:p> away</p>")
+    assert str(get_cleaned_html(page)) == "<p>To Town, State</p><p>Far away</p>"
+
+
+def test_missing_parser_falls_back():
+    assert resolve_parser("not-a-parser") == "html.parser"
+    assert resolve_parser("auto") in ("lxml", "html.parser")
+
+
 @pytest.mark.asyncio
 async def test_lparchive2epub(lp, b3sum):
     pytest.skip("Unable to run until ebooklib update")
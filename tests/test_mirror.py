@@ -0,0 +1,29 @@
+import aiohttp
+import pytest
+
+from lparchive2epub.lib import get_landing_summary
+from lparchive2epub.mirror import MirrorManifest, file_hash
+
+
+@pytest.mark.asyncio
+async def test_landing_summary_tells_when_a_book_is_outdated(tmp_path, lparchive):
+    book = tmp_path / "book.epub"
+    book.write_bytes(b"not really a book")
+    manifest = MirrorManifest(str(tmp_path / "manifest.sqlite"))
+    hits = lparchive.hits
+    async with lparchive, aiohttp.ClientSession() as session:
+        url = lparchive.url()
+        summary = await get_landing_summary(session, url)
+        assert (summary.published_on, summary.chapters) == ("Jan 02, 2020", lparchive.chapters)
+        manifest.record("/Fake-LP", summary.published_on, summary.chapters, str(book))
+
+        assert manifest.get("/Fake-LP").matches(summary.published_on, summary.chapters)
+        lparchive.chapters += 1
+        summary = await get_landing_summary(session, url)
+        assert not manifest.get("/Fake-LP").matches(summary.published_on, summary.chapters)
+
+    # only the landing page was needed
+    assert set(hits) == {"/Fake-LP"}
+    assert manifest.get("/Fake-LP").output_hash == file_hash(str(book))
+    assert manifest.get("/Other-LP") is None
+    manifest.close()
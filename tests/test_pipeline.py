@@ -0,0 +1,228 @@
+import asyncio
+import gc
+import time
+import zipfile
+
+import ebooklib
+import pytest
+from bs4 import Tag
+from ebooklib import epub
+
+from lparchive2epub import lib, writer
+from lparchive2epub.journal import journal_path
+from lparchive2epub.store import ImageStore
+from lparchive2epub.writer import ReorderBuffer
+
+
+@pytest.mark.asyncio
+async def test_pipeline_builds_book_and_fetches_each_image_once(tmp_path, lparchive):
+    hits = lparchive.hits
+    out = tmp_path / "book.epub"
+    async with lparchive:
+        await lparchive.build(out)
+
+    assert hits["/img/banner.png"] == 1
+    assert all(v == 1 for k, v in hits.items() if k.startswith("/img/"))
+    assert hits["/Fake-LP"] == 1
+
+    with zipfile.ZipFile(out) as z:
+        names = z.namelist()
+        assert names[0] == "mimetype"
+        assert len([x for x in names if x.startswith("EPUB/images/")]) == 1 + 2 * lparchive.chapters
+        # images are compressed already, only text is deflated
+        assert {x.compress_type for x in z.infolist() if x.filename.startswith("EPUB/images/")} == \
+               {zipfile.ZIP_STORED}
+        assert z.getinfo("EPUB/update_0.xhtml").compress_type == zipfile.ZIP_DEFLATED
+        for i in range(lparchive.chapters):
+            chapter = z.read(f"EPUB/update_{i}.xhtml").decode()
+            assert "../img" not in chapter
+            assert "st1:place" not in chapter
+            assert "images/" in chapter
+
+
+@pytest.mark.asyncio
+async def test_pipeline_output_is_deterministic(tmp_path, lparchive):
+    async with lparchive:
+        await lparchive.build(tmp_path / "a.epub")
+        await lparchive.build(tmp_path / "b.epub")
+
+    assert (tmp_path / "a.epub").read_bytes() == (tmp_path / "b.epub").read_bytes()
+    book = epub.read_epub(str(tmp_path / "a.epub"))
+    assert book.title == "Fake LP"
+    assert [x.file_name for x in book.get_items_of_type(ebooklib.ITEM_DOCUMENT)][:3] == \
+           ["introduction.xhtml", "update_0.xhtml", "update_1.xhtml"]
+
+
+@pytest.mark.asyncio
+async def test_reorder_buffer_flushes_in_key_order():
+    flushed = []
+    buffer = ReorderBuffer(flushed.append, window=3)
+
+    async def produce(key, delay):
+        await buffer.reserve(key)
+        await asyncio.sleep(delay)
+        await buffer.push(key, key)
+
+    await asyncio.gather(*(produce(k, (5 - k) * 0.002) for k in range(6)))
+    assert flushed == list(range(6))
+    assert len(buffer) == 0
+
+
+@pytest.mark.asyncio
+async def test_pipeline_spooled_images_give_the_same_book(tmp_path, lparchive):
+    async with lparchive:
+        await lparchive.build(tmp_path / "memory.epub")
+        await lparchive.build(tmp_path / "disk.epub", image_memory_budget=0)
+
+    assert (tmp_path / "memory.epub").read_bytes() == (tmp_path / "disk.epub").read_bytes()
+
+
+@pytest.mark.asyncio
+async def test_pipeline_resumes_from_journal_after_failure(tmp_path, monkeypatch, lparchive):
+    hits = lparchive.hits
+    out = tmp_path / "book.epub"
+    real_build_single_page = lib.build_single_page
+
+    async def last_chapter_fails(session, intro, chapter, *args):
+        if chapter.num == lparchive.chapters - 1:
+            # give the other chapters time to finish
+            await asyncio.sleep(0.2)
+            raise RuntimeError("gave up")
+        return await real_build_single_page(session, intro, chapter, *args)
+
+    async with lparchive:
+        await lparchive.build(tmp_path / "reference.epub")
+        monkeypatch.setattr(lib, "build_single_page", last_chapter_fails)
+        with pytest.raises(RuntimeError, match="gave up"):
+            await lparchive.build(out)
+        assert not out.exists()
+        assert (tmp_path / journal_path("book.epub")).exists()
+
+        monkeypatch.setattr(lib, "build_single_page", real_build_single_page)
+        hits.clear()
+        await lparchive.build(out)
+
+    assert sum(v for k, v in hits.items() if k.startswith("/Fake-LP/Update")) == 1
+    assert out.read_bytes() == (tmp_path / "reference.epub").read_bytes()
+    assert not (tmp_path / journal_path("book.epub")).exists()
+
+
+@pytest.mark.asyncio
+async def test_pipeline_update_only_fetches_new_chapters(tmp_path, lparchive):
+    hits = lparchive.hits
+    chapters = lparchive.chapters
+    out = tmp_path / "book.epub"
+    async with lparchive:
+        lparchive.chapters = chapters - 2
+        await lparchive.build(out)
+        lparchive.chapters = chapters
+        await lparchive.build(tmp_path / "reference.epub")
+        hits.clear()
+        await lparchive.build(out, previous=str(out))
+
+    # the previous last chapter is rebuilt for its link to the next one
+    assert [hits[f"/Fake-LP/Update {i}/"] for i in range(1, chapters + 1)] == [0] * (chapters - 3) + [1] * 3
+    assert sorted(k for k in hits if k.startswith("/img/shot")) == \
+           [f"/img/shot{i}.png" for i in range(chapters - 2, chapters + 1)]
+    assert out.read_bytes() == (tmp_path / "reference.epub").read_bytes()
+
+
+@pytest.mark.asyncio
+async def test_pipeline_update_keeps_the_previous_book_open_until_written(tmp_path, monkeypatch, lparchive):
+    chapters = lparchive.chapters
+    out = tmp_path / "book.epub"
+    real_write_stream = writer._DeterministicZip.write_stream
+
+    def slow_write_stream(*args, **kwargs):
+        time.sleep(0.02)
+        return real_write_stream(*args, **kwargs)
+
+    async with lparchive:
+        lparchive.chapters = chapters - 2
+        await lparchive.build(out)
+        lparchive.chapters = chapters
+        await lparchive.build(tmp_path / "reference.epub")
+        # the images kept from the previous book are still being written when the new chapters are done
+        monkeypatch.setattr(writer._DeterministicZip, "write_stream", slow_write_stream)
+        await lparchive.build(out, previous=str(out))
+
+    assert out.read_bytes() == (tmp_path / "reference.epub").read_bytes()
+
+
+@pytest.mark.asyncio
+async def test_pipeline_process_pool_gives_the_same_book(tmp_path, lparchive):
+    async with lparchive:
+        await lparchive.build(tmp_path / "inline.epub")
+        await lparchive.build(tmp_path / "pool.epub", transform_workers=2)
+
+    assert (tmp_path / "inline.epub").read_bytes() == (tmp_path / "pool.epub").read_bytes()
+
+
+@pytest.mark.asyncio
+async def test_pipeline_keeps_no_parse_tree_while_writing_chapters(tmp_path, monkeypatch, lparchive):
+    alive = []
+    real_add_page = lib.add_page
+
+    def add_page(*args, **kwargs):
+        gc.collect()
+        alive.append(sum(isinstance(x, Tag) for x in gc.get_objects()))
+        return real_add_page(*args, **kwargs)
+
+    monkeypatch.setattr(lib, "add_page", add_page)
+    async with lparchive:
+        await lparchive.build(tmp_path / "book.epub")
+
+    # the first call is the introduction, built while the landing page tree is still around
+    assert len(alive) == 1 + lparchive.chapters
+    assert alive[1:] == [0] * lparchive.chapters
+
+
+@pytest.mark.asyncio
+async def test_pipeline_image_store_is_shared_between_runs(tmp_path, lparchive):
+    hits = lparchive.hits
+    store = ImageStore(str(tmp_path / "images.sqlite"))
+    async with lparchive:
+        await lparchive.build(tmp_path / "reference.epub")
+        await lparchive.build(tmp_path / "first.epub", image_store=store)
+        hits.clear()
+        await lparchive.build(tmp_path / "second.epub", image_store=store)
+    store.close()
+
+    assert not any(k.startswith("/img/") for k in hits)
+    assert (tmp_path / "first.epub").read_bytes() == (tmp_path / "reference.epub").read_bytes()
+    assert (tmp_path / "second.epub").read_bytes() == (tmp_path / "reference.epub").read_bytes()
+
+
+@pytest.mark.asyncio
+async def test_pipeline_keeps_pages_whose_images_are_gone(tmp_path, lparchive):
+    lparchive.dead_images = True
+    messages = []
+    out = tmp_path / "book.epub"
+    async with lparchive:
+        await lparchive.build(out, writer=messages.append)
+        gone = [lparchive.url(f"/img/gone{i}.png") for i in range(1, lparchive.chapters + 1)]
+
+    with zipfile.ZipFile(out) as z:
+        assert len([x for x in z.namelist() if x.startswith("EPUB/images/")]) == 1 + 2 * lparchive.chapters
+        for i in range(lparchive.chapters):
+            chapter = z.read(f"EPUB/update_{i}.xhtml").decode()
+            assert f'src="{gone[i]}"' in chapter
+            assert "images/" in chapter
+    # a missing image isn't worth retrying
+    assert all(lparchive.hits[f"/img/gone{i}.png"] == 1 for i in range(1, lparchive.chapters + 1))
+    assert any(f"{lparchive.chapters} images could not be fetched" in x for x in messages)
+
+
+@pytest.mark.asyncio
+async def test_pipeline_writes_images_repeated_in_a_page(tmp_path, lparchive):
+    lparchive.repeated_images = True
+    async with lparchive:
+        await lparchive.build(tmp_path / "memory.epub")
+        await lparchive.build(tmp_path / "disk.epub", image_memory_budget=0)
+
+    for name in ["memory.epub", "disk.epub"]:
+        with zipfile.ZipFile(tmp_path / name) as z:
+            images = [x for x in z.infolist() if x.filename.startswith("EPUB/images/")]
+            assert len(images) == 1 + 2 * lparchive.chapters
+            assert all(x.file_size > 0 for x in images)
+    assert (tmp_path / "memory.epub").read_bytes() == (tmp_path / "disk.epub").read_bytes()
@@ -0,0 +1,112 @@
+import asyncio
+import email.utils
+import time
+from collections import Counter
+from urllib.parse import urlparse
+
+import aiohttp
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from lparchive2epub.lib import get_resource_with_retries
+from lparchive2epub.limiter import CircuitBreaker, PerHostLimiter, RateLimit, network_trace
+from lparchive2epub.retry import HttpStatusError, RetryBudget, RetryPolicy, parse_retry_after
+
+
+def fast_policy(**kwargs) -> RetryPolicy:
+    return RetryPolicy(base=0.001, cap=0.01, **kwargs)
+
+
+def throttling_server(hits: Counter, refusals: int, retry_after: str) -> TestServer:
+    async def handle(request: web.Request):
+        hits[request.path] += 1
+        if hits[request.path] <= refusals:
+            return web.Response(status=429, headers={"Retry-After": retry_after})
+        return web.Response(text="ok")
+
+    app = web.Application()
+    app.router.add_get("/{tail:.*}", handle)
+    return TestServer(app)
+
+
+def test_retry_after_is_read_as_seconds_or_date():
+    assert parse_retry_after("3") == 3.0
+    assert parse_retry_after(None) is None
+    assert parse_retry_after("soon") is None
+    later = parse_retry_after(email.utils.formatdate(time.time() + 60, usegmt=True))
+    assert 55 < later <= 60
+
+
+@pytest.mark.asyncio
+async def test_missing_resources_are_not_retried(lparchive):
+    hits = lparchive.hits
+    async with lparchive, aiohttp.ClientSession() as session:
+        with pytest.raises(HttpStatusError) as e:
+            await get_resource_with_retries(session, lparchive.url("/img/gone.png"), retry=fast_policy())
+    assert e.value.status == 404
+    assert hits["/img/gone.png"] == 1
+
+
+@pytest.mark.asyncio
+async def test_throttling_waits_for_retry_after():
+    hits = Counter()
+    async with throttling_server(hits, 2, "0.05") as server, aiohttp.ClientSession() as session:
+        started = time.monotonic()
+        assert await get_resource_with_retries(session, str(server.make_url("/page")), retry=fast_policy()) == "ok"
+        assert time.monotonic() - started >= 0.1
+        # waiting longer than the policy allows is not worth it
+        with pytest.raises(HttpStatusError):
+            await get_resource_with_retries(session, str(server.make_url("/other")),
+                                            retry=fast_policy(max_retry_after=0.01))
+    assert hits["/page"] == 3
+    assert hits["/other"] == 1
+
+
+@pytest.mark.asyncio
+async def test_retry_budget_fails_fast_once_a_host_is_down(lparchive):
+    hits = lparchive.hits
+    lparchive.broken.update({"/a", "/b", "/c"})
+    policy = fast_policy(budget=RetryBudget(retries=4))
+    async with lparchive, aiohttp.ClientSession() as session:
+        for path in ["/a", "/b", "/c"]:
+            with pytest.raises(RuntimeError):
+                await get_resource_with_retries(session, lparchive.url(path), retry=policy)
+
+    # the first request spends the whole budget, the others only get their first attempt
+    assert hits["/a"] == policy.attempts
+    assert hits["/b"] == 1
+    assert hits["/c"] == 1
+
+
+@pytest.mark.asyncio
+async def test_the_deadline_starts_once_the_breaker_lets_the_request_through(lparchive):
+    hits = lparchive.hits
+    async with lparchive, aiohttp.ClientSession() as session:
+        url = lparchive.url()
+        breaker = CircuitBreaker(urlparse(url).netloc, threshold=1, pause=0.3)
+        limiter = PerHostLimiter(breaker=breaker)
+        breaker.failure()
+        assert not breaker.closed
+        # the probe waits longer than the whole deadline before being sent
+        await get_resource_with_retries(session, url, limiter=limiter, retry=fast_policy(deadline=0.2))
+
+    assert hits["/Fake-LP"] == 1
+    assert breaker.closed
+    [metrics] = limiter.metrics()
+    assert metrics.decreases == 0
+
+
+@pytest.mark.asyncio
+async def test_queueing_for_the_window_and_the_rate_limit_does_not_time_out(lparchive):
+    hits = lparchive.hits
+    limiter = PerHostLimiter(rate_limit=RateLimit(10), initial=1, maximum=1)
+    async with lparchive, aiohttp.ClientSession(trace_configs=[network_trace()]) as session:
+        url = lparchive.url()
+        # the last ones queue for longer than the deadline
+        await asyncio.gather(*(get_resource_with_retries(session, url, limiter=limiter,
+                                                         retry=fast_policy(deadline=0.2)) for _ in range(5)))
+
+    assert hits["/Fake-LP"] == 5
+    [metrics] = limiter.metrics()
+    assert (metrics.requests, metrics.decreases) == (5, 0)
@@ -0,0 +1,77 @@
+import io
+from collections import Counter
+
+import pytest
+
+from lparchive2epub import lib, shrink as shrink_module
+from lparchive2epub.shrink import ShrinkCache, ShrinkOptions, shrink_image
+
+Image = pytest.importorskip("PIL.Image")
+
+
+def encoded(image, image_format: str, **kwargs) -> bytes:
+    out = io.BytesIO()
+    image.save(out, image_format, **kwargs)
+    return out.getvalue()
+
+
+def test_shrink_downscales_and_keeps_the_format():
+    data = encoded(Image.effect_noise((800, 600), 64).convert("RGB"), "JPEG", quality=95)
+    shrunk = shrink_image(data, ShrinkOptions(max_dimension=200, quality=70))
+    assert len(shrunk) < len(data)
+    result = Image.open(io.BytesIO(shrunk))
+    assert result.format == "JPEG"
+    assert result.size == (200, 150)
+
+
+def test_shrink_only_flattens_animations_on_request():
+    frames = [Image.new("P", (32, 32), c) for c in range(4)]
+    data = encoded(frames[0], "GIF", save_all=True, append_images=frames[1:])
+    assert shrink_image(data, ShrinkOptions()) == data
+    first = Image.open(io.BytesIO(shrink_image(data, ShrinkOptions(first_frame=True))))
+    assert not getattr(first, "is_animated", False)
+    # anything that isn't an image is left alone
+    assert shrink_image(b"not an image", ShrinkOptions()) == b"not an image"
+
+
+@pytest.mark.asyncio
+async def test_pipeline_shrinks_each_image_once_across_builds(tmp_path, monkeypatch, lparchive):
+    calls = Counter()
+    real_shrink_image = shrink_module.shrink_image
+
+    def counting_shrink_image(data, options):
+        calls[len(data)] += 1
+        return real_shrink_image(data, options)
+
+    monkeypatch.setattr(shrink_module, "shrink_image", counting_shrink_image)
+    cache = ShrinkCache(str(tmp_path / "shrunk.sqlite"))
+    async with lparchive:
+        await lparchive.build(tmp_path / "reference.epub")
+        await lparchive.build(tmp_path / "first.epub", shrink=ShrinkOptions(), shrink_cache=cache)
+        first_calls = sum(calls.values())
+        await lparchive.build(tmp_path / "second.epub", shrink=ShrinkOptions(), shrink_cache=cache)
+    cache.close()
+
+    assert first_calls > 0
+    assert sum(calls.values()) == first_calls
+    # the fake images can't be made smaller, so nothing changes
+    assert (tmp_path / "first.epub").read_bytes() == (tmp_path / "reference.epub").read_bytes()
+    assert (tmp_path / "second.epub").read_bytes() == (tmp_path / "reference.epub").read_bytes()
+
+
+@pytest.mark.asyncio
+async def test_pipeline_shrinks_in_the_transform_processes(tmp_path, monkeypatch, lparchive):
+    ran = Counter()
+    real_run = lib.Transformer.run
+
+    async def counting_run(self, fn, *args):
+        ran[fn.__name__] += 1
+        return await real_run(self, fn, *args)
+
+    monkeypatch.setattr(lib.Transformer, "run", counting_run)
+    async with lparchive:
+        await lparchive.build(tmp_path / "reference.epub")
+        await lparchive.build(tmp_path / "shrunk.epub", shrink=ShrinkOptions(), transform_workers=2)
+
+    assert ran["shrink_image"] > 0
+    assert (tmp_path / "shrunk.epub").read_bytes() == (tmp_path / "reference.epub").read_bytes()
@@ -0,0 +1,71 @@
+import os
+from hashlib import blake2b
+
+import pytest
+
+from lparchive2epub.spool import ImageSpool
+
+
+async def chunks(*parts: bytes):
+    for p in parts:
+        yield p
+
+
+@pytest.mark.asyncio
+async def test_spool_keeps_small_images_in_memory():
+    spool = ImageSpool(memory_budget=1024)
+    image = await spool.store(chunks(b"abc", b"def"))
+    assert image.hash == blake2b(b"abcdef").hexdigest()
+    assert image.path is None
+    assert image.read() == b"abcdef"
+    assert spool.in_memory == 6
+    image.release()
+    assert spool.in_memory == 0
+    spool.close()
+
+
+@pytest.mark.asyncio
+async def test_spool_spills_over_budget_to_disk():
+    spool = ImageSpool(memory_budget=8)
+    small = await spool.store(chunks(b"12345"))
+    big = await spool.store(chunks(b"abc", b"def", b"ghi"))
+    assert small.path is None
+    assert big.path is not None and os.path.exists(big.path)
+    assert big.read() == b"abcdefghi"
+    assert big.hash == blake2b(b"abcdefghi").hexdigest()
+    assert spool.in_memory == 5
+    assert spool.spilled == 1
+    big.release()
+    assert not os.listdir(spool.directory)
+    directory = spool.directory
+    spool.close()
+    assert not os.path.exists(directory)
+
+
+@pytest.mark.asyncio
+async def test_spool_discards_partial_bodies():
+    spool = ImageSpool(memory_budget=2)
+
+    async def broken():
+        yield b"abcdef"
+        raise ConnectionResetError()
+
+    with pytest.raises(ConnectionResetError):
+        await spool.store(broken())
+    assert spool.in_memory == 0
+    assert not os.listdir(spool.directory)
+    spool.close()
+
+
+@pytest.mark.asyncio
+async def test_spool_keeps_identical_images_apart():
+    spool = ImageSpool(memory_budget=0)
+    first = await spool.store(chunks(b"same bytes"))
+    second = await spool.store(chunks(b"same bytes"))
+    assert first.hash == second.hash
+    assert first.path != second.path
+    first.release()
+    assert second.read() == b"same bytes"
+    second.release()
+    assert not os.listdir(spool.directory)
+    spool.close()
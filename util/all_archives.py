@@ -4,58 +4,203 @@ import logging
 import multiprocessing
 import os
 import re
+import socket
+import traceback
 from argparse import ArgumentParser
+from collections import Counter
+from queue import Empty
+from urllib.parse import urlparse
 
-import aiohttp
 from bs4 import BeautifulSoup
 
-from lparchive2epub.lib import lparchive2epub
+from lparchive2epub.connections import ConnectionPool
+from lparchive2epub.jobs import JobQueue
+from lparchive2epub.cache import CompressedSQLiteBackend, RevalidatingSQLiteBackend, is_landing_page
+from lparchive2epub.lib import get_landing_summary, lparchive2epub
+from lparchive2epub.limiter import CircuitBreaker, PerHostLimiter, RateLimit
+from lparchive2epub.mirror import MirrorManifest
+from lparchive2epub.retry import RetryPolicy
+from lparchive2epub.store import ImageStore
 from aiohttp import ClientSession
 from tqdm.asyncio import tqdm
-from aiohttp_client_cache import CachedSession, SQLiteBackend, FileBackend
 
 processes = multiprocessing.cpu_count()
+DEFAULT_RATE = 10.0
+LPARCHIVE = "https://lparchive.org"
+# what every book in the output directory was built from
+MANIFEST_FILE = "manifest.sqlite"
+# a let's play interrupted by lparchive this many times is reported as failed, it may be what keeps tripping it
+MAX_REQUEUES = 3
+# sent instead of the outcome of a job whose lease was lost, another worker converts it
+LEASE_LOST = "lost"
+# room for the url a worker is converting, see work
+MAX_URL = 1024
 
 
-async def do_single(arguments, url, pbar, failed, cache_path):
-    logger = logging.getLogger("all_lp_archive_to_epub")
+async def do_single(arguments, url, cache_path, image_store, limiter, retry, manifest, pool):
+    # returns the failure, if any, whether the book was already up to date, and whether lparchive stopped answering
+    # while it was converted, in which case the let's play can go back in the queue
+    breaker = limiter.breaker
+    trips = breaker.trips
+    full_url = arguments.site + url
+    output = f"{arguments.output[0]}{os.path.sep}{url.replace('/', '')}.epub"
+
+    summary = None
+    try:
+        async with pool.session() as session:
+            summary = await get_landing_summary(session, full_url, limiter, retry=retry)
+    except Exception:
+        # the conversion fetches it again and reports what went wrong
+        pass
+    else:
+        built = await asyncio.to_thread(manifest.get, url)
+        if (not arguments.force and built and built.matches(summary.published_on, summary.chapters)
+                and os.path.exists(output)):
+            return None, True, False
+
     exc = None
-    cache = SQLiteBackend(f"{cache_path}{os.path.sep}{url.replace('/', '')}", expire_after=-1, autoclose=False)
-    conn = aiohttp.TCPConnector(force_close=True)
-    connection = CachedSession(cache=cache, connector=conn)
+    cache_file = f"{cache_path}{os.path.sep}{url.replace('/', '')}"
+    if arguments.revalidate:
+        # pages are checked with lparchive on every run, so edited updates are picked up
+        cache = RevalidatingSQLiteBackend(cache_file, expire_after=-1, autoclose=False)
+    else:
+        # landing pages always come from lparchive, so new updates are seen
+        cache = CompressedSQLiteBackend(cache_file, expire_after=-1, autoclose=False,
+                                        filter_fn=lambda r: not is_landing_page(r))
+    # every let's play has its own cache, the connections to lparchive are kept from one to the next
+    connection = pool.session(cache)
     try:
-        await lparchive2epub("https://lparchive.org" + url,
-                                f"{arguments.output[0]}{os.path.sep}{url.replace('/', '')}.epub",
-                                connection)
-    except (aiohttp.client_exceptions.ServerDisconnectedError, TimeoutError, RuntimeError) as disconnected:
-        exc = disconnected
-        await asyncio.sleep(5)
+        await lparchive2epub(full_url, output,
+                                connection, writer=lambda *_: None, limiter=limiter, image_store=image_store,
+                                transform_workers=0, retry=retry)
     except Exception as e:
         exc = e
     else:
-        pbar.update(1)
-        return None
+        if summary:
+            await asyncio.to_thread(manifest.record, url, summary.published_on, summary.chapters, output)
+        return None, False, False
     finally:
         await connection.close()
         await cache.close()
 
-    pbar.write(f"failed to download {url} : {str(exc)}")
-    logger.error("error:", exc_info=exc)
-    failed.append(f"url: {url}, exc: {exc}")
-    pbar.update(1)
-    return url, exc
+    # when interrupted it likely isn't this let's play's fault; its journal keeps what was done for the next try
+    return failure_of(url, exc), False, breaker.trips != trips or not breaker.closed
+
+
+def failure_of(url, exc):
+    return {
+        "url": url,
+        "error": type(exc).__name__,
+        "message": str(exc),
+        "traceback": "".join(traceback.format_exception(exc)),
+    }
+
+
+async def convert(arguments, url, cache_path, image_store, limiter, retry, manifest, pool):
+    # the manifest and the caches are used outside of the conversion itself; whatever goes wrong with them fails
+    # this let's play only, instead of taking the worker and the url it had down
+    try:
+        return await do_single(arguments, url, cache_path, image_store, limiter, retry, manifest, pool)
+    except Exception as e:
+        return failure_of(url, e), False, False
+
+
+def give_up(failure, interrupted, requeues):
+    # whether an interrupted let's play goes back in the queue, the failure is kept once it went back too often
+    if interrupted and requeues < MAX_REQUEUES:
+        return None, True
+    if interrupted:
+        failure["message"] = (f"lparchive stopped answering {requeues + 1} times while converting it: "
+                              f"{failure['message']}")
+    return failure, False
+
 
+async def keep_leased(jobs, url, name, conversion):
+    while True:
+        await asyncio.sleep(jobs.lease_duration / 3)
+        if not await asyncio.to_thread(jobs.heartbeat, url, name):
+            # the lease expired and another worker may have the job by now, writing the same book and journal
+            conversion.cancel()
+            return
 
-async def get_frontpage():
+
+async def work(arguments, cache_path, store_path, rate_limit, breaker, urls, results, current):
+    # one let's play at a time per process; the limiter keeps what it learned about lparchive between them,
+    # and the retry budget which image hosts are down.
+    # `current` holds the url being converted, in shared memory: a message could be lost with a killed process
+    image_store = ImageStore(store_path)
+    manifest = MirrorManifest(f"{arguments.output[0]}{os.path.sep}{MANIFEST_FILE}")
+    limiter = PerHostLimiter(rate_limit=rate_limit, breaker=breaker)
+    retry = RetryPolicy()
+    jobs = JobQueue(arguments.jobs) if arguments.jobs else None
+    name = f"{socket.gethostname()}:{os.getpid()}"
+    try:
+        # kept-alive connections, DNS and TLS setup are shared by every let's play of this process
+        async with ConnectionPool() as pool:
+            while True:
+                if jobs:
+                    url = await asyncio.to_thread(jobs.lease, name)
+                else:
+                    # queued with the number of times it was already put back
+                    item = await asyncio.to_thread(urls.get)
+                    url = item[0] if item else None
+                if url is None:
+                    break
+                current.value = url.encode()
+                if not jobs:
+                    failure, skipped, interrupted = await convert(arguments, url, cache_path, image_store,
+                                                                  limiter, retry, manifest, pool)
+                    failure, requeued = give_up(failure, interrupted, item[1])
+                    if requeued:
+                        urls.put((url, item[1] + 1))
+                    results.put((url, (failure, skipped, requeued)))
+                    current.value = b""
+                    continue
+                requeues = await asyncio.to_thread(jobs.requeues, url)
+                conversion = asyncio.create_task(convert(arguments, url, cache_path, image_store, limiter, retry,
+                                                         manifest, pool))
+                heartbeat = asyncio.create_task(keep_leased(jobs, url, name, conversion))
+                try:
+                    failure, skipped, interrupted = await conversion
+                except asyncio.CancelledError:
+                    if asyncio.current_task().cancelling():
+                        raise
+                    # not done, and not failed either: it is another worker's job now
+                    results.put((url, LEASE_LOST))
+                    current.value = b""
+                    continue
+                finally:
+                    heartbeat.cancel()
+                failure, requeued = give_up(failure, interrupted, requeues)
+                if requeued:
+                    await asyncio.to_thread(jobs.release, url, name)
+                elif failure:
+                    await asyncio.to_thread(jobs.fail, url, name, failure["traceback"])
+                else:
+                    await asyncio.to_thread(jobs.done, url, name)
+                results.put((url, (failure, skipped, requeued)))
+                current.value = b""
+    finally:
+        image_store.close()
+        manifest.close()
+        if jobs:
+            jobs.close()
+
+
+def worker(arguments, cache_path, store_path, rate_limit, breaker, urls, results, current):
+    asyncio.run(work(arguments, cache_path, store_path, rate_limit, breaker, urls, results, current))
+
+
+async def get_frontpage(site):
     async with ClientSession() as session:
-        p = await session.get("https://lparchive.org/")
+        p = await session.get(f"{site}/")
 
         soup = BeautifulSoup(await p.text(), "html.parser")
     return soup
 
 
 async def do(arguments):
-    soup = await get_frontpage()
+    soup = await get_frontpage(arguments.site)
 
     # now for some "magic"
     # there's a javascript embedded in the page that contains all the content to populate the table at the bottom
@@ -71,21 +216,119 @@ async def do(arguments):
 
     logging.basicConfig(filename=f"{arguments.output[0]}{os.path.sep}/errors.log", level=logging.WARN,
                         format='%(asctime)s %(levelname)s %(name)s %(message)s')
-
-    failed = []
+    logger = logging.getLogger("all_lp_archive_to_epub")
 
     cache_path = arguments.cache_path
     if not cache_path:
         cache_path = f"{arguments.output[0]}{os.path.sep}/cache"
 
+    # images are shared by every let's play, so banners and smilies are only downloaded once
+    os.makedirs(cache_path, exist_ok=True)
+    store_path = arguments.image_store or f"{cache_path}{os.path.sep}images.sqlite"
+    # created once here so the schemas exist before the workers open them
+    ImageStore(store_path).close()
+    MirrorManifest(f"{arguments.output[0]}{os.path.sep}{MANIFEST_FILE}").close()
+
+    # with a job table the work is shared with every other node using it, otherwise it stays in this run
+    jobs = None
+    total = len(urls)
+    if arguments.jobs:
+        jobs = JobQueue(arguments.jobs)
+        print(f"{jobs.add(urls)} new let's plays in {arguments.jobs}")
+        if arguments.retry_failed:
+            print(f"{jobs.retry_failed()} failed let's plays will be tried again")
+        total = jobs.counts().get("pending", 0)
 
-    with tqdm(total=len(urls)) as pbar:
+    # spawned rather than forked: every worker runs its own event loop
+    context = multiprocessing.get_context("spawn")
+    rate_limit = RateLimit(arguments.rate, context)
+    # when lparchive stops answering every worker pauses, instead of each one failing let's play after let's play
+    breaker = CircuitBreaker(urlparse(arguments.site).netloc, context=context)
+    queue = context.Queue()
+    results = context.Queue()
+    if not jobs:
         for url in urls:
-           r =  await do_single(arguments, url, pbar, failed, cache_path)
+            queue.put((url, 0))
+    current = [context.Array("c", MAX_URL, lock=False) for _ in range(arguments.processes)]
+    workers = [context.Process(target=worker,
+                               args=(arguments, cache_path, store_path, rate_limit, breaker, queue, results, x))
+               for x in current]
+    for w in workers:
+        w.start()
+    # with a job table workers stop by themselves once it has nothing left for them
+    stopping = bool(jobs)
+
+    failed = []
+    succeeded = 0
+    unchanged = 0
+    requeued_count = 0
+    finished = 0
+    # let's plays whose outcome came back from a worker
+    reported = set()
+    with tqdm(total=total) as pbar:
+        while any(w.is_alive() for w in workers) or not results.empty():
+            # a let's play requeued by a worker that died right after may be counted twice
+            if not stopping and finished >= total:
+                # requeued let's plays are put back by the workers, so the queue can only be closed now
+                for _ in workers:
+                    queue.put(None)
+                stopping = True
+            try:
+                url, outcome = await asyncio.to_thread(results.get, timeout=1)
+            except Empty:
+                # nothing more can come from a dead worker by now, what it was converting is lost
+                for w, converting in zip(workers, current):
+                    url = converting.value.decode()
+                    if w.exitcode and url and url not in reported:
+                        converting.value = b""
+                        pbar.write(f"worker {w.pid} died with exit code {w.exitcode} while converting {url}")
+                        logger.error(f"{url}: worker {w.pid} died with exit code {w.exitcode}")
+                        if jobs:
+                            # its lease expires and another worker takes it again
+                            continue
+                        finished += 1
+                        pbar.update(1)
+                        failed.append({"url": url, "error": "WorkerDied", "message": f"exit code {w.exitcode}",
+                                       "traceback": ""})
+                continue
+            if outcome == LEASE_LOST:
+                pbar.write(f"the lease on {url} expired, it was left to the worker that has it now")
+                continue
+            failure, skipped, requeued = outcome
+            if requeued:
+                requeued_count += 1
+                pbar.write(f"lparchive stopped answering while converting {url}, it will be tried again")
+                continue
+            reported.add(url)
+            finished += 1
+            pbar.update(1)
+            if skipped:
+                unchanged += 1
+            elif not failure:
+                succeeded += 1
+            else:
+                pbar.write(f"failed to download {url} : {failure['message']}")
+                logger.error(f"{url}: {failure['traceback']}")
+                failed.append(failure)
+
+    for w in workers:
+        w.join()
 
-    for url in failed:
-        print(json.dumps(url))
-    print(f"downloaded {len(urls) - len(failed)} out of {len(urls)}")
+    # one report for the whole run, or for every node when they share a job table
+    if jobs:
+        failed = [{"url": x.url, "worker": x.worker, "attempts": x.attempts,
+                   "error": x.error.splitlines()[-1].split(":")[0], "message": x.error.splitlines()[-1],
+                   "traceback": x.error} for x in jobs.failures()]
+        counts = jobs.counts()
+        jobs.close()
+        print(", ".join(f"{v} {k}" for k, v in sorted(counts.items())))
+    report = f"{arguments.output[0]}{os.path.sep}failures.json"
+    with open(report, "w") as f:
+        json.dump(failed, f, indent=1)
+    for error, count in Counter(x["error"] for x in failed).most_common():
+        print(f"{count} x {error}")
+    print(f"downloaded {succeeded} out of {total}, {unchanged} unchanged since the last run, "
+          f"{requeued_count} conversions interrupted by lparchive and tried again, failures in {report}")
 
 
 if __name__ == '__main__':
@@ -96,6 +339,23 @@ if __name__ == '__main__':
 
     arg_parser.add_argument("output", metavar="OUTPUT_FILE", nargs=1, type=str)
     arg_parser.add_argument("--cache_path", metavar="CACHE_PATH", type=str, help="Path to SQLite cache file")
+    arg_parser.add_argument("--processes", metavar="N", type=int, default=processes,
+                            help="Worker processes, each converting one let's play at a time (default: %(default)s)")
+    arg_parser.add_argument("--rate", metavar="REQUESTS", type=float, default=DEFAULT_RATE,
+                            help="Requests per second allowed across all workers (default: %(default)s)")
+    arg_parser.add_argument("--jobs", metavar="JOBS", type=str,
+                            help="SQLite job table to share the work with other machines; they must all be able to "
+                                 "open it and lock it (a local disk or a share with working locks)")
+    arg_parser.add_argument("--retry_failed", action="store_true", help="Put failed jobs of JOBS back in the queue")
+    arg_parser.add_argument("--force", action="store_true",
+                            help=f"Rebuild every let's play, even those {MANIFEST_FILE} says are up to date")
+    arg_parser.add_argument("--revalidate", action="store_true",
+                            help="Revalidate cached pages with lparchive (ETag / Last-Modified) instead of trusting "
+                                 "them forever; images stay cached")
+    arg_parser.add_argument("--site", metavar="URL", type=str, default=LPARCHIVE,
+                            help="Where to get the let's plays from, lparchive or a copy of it (default: %(default)s)")
+    arg_parser.add_argument("--image_store", metavar="IMAGE_STORE", type=str,
+                            help="SQLite file of images shared by all let's plays (default: images.sqlite in CACHE_PATH)")
 
 
     args = arg_parser.parse_args()
@@ -0,0 +1,81 @@
+# Compresses the pages of url caches written before they were stored compressed, and recompresses the ones
+# written with another dictionary when it is given with --dictionary. Images are left as they are.
+# python util/migrate_cache.py ~/.cache/lparchive2epub/http_cache.sqlite cache/
+import os
+import sqlite3
+from argparse import ArgumentParser
+
+from lparchive2epub.compression import CompressingSerializer
+
+# rows rewritten per transaction
+BATCH = 500
+
+
+def cache_files(paths: list[str]) -> list[str]:
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            found += sorted(os.path.join(path, x) for x in os.listdir(path) if x.endswith(".sqlite"))
+        else:
+            found.append(path)
+    return found
+
+
+def migrate(path: str, old: CompressingSerializer, new: CompressingSerializer) -> tuple[int, int, int]:
+    # returns the number of rewritten entries and the file size before and after
+    before = os.path.getsize(path)
+    db = sqlite3.connect(path, timeout=60)
+    try:
+        if not db.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='responses'").fetchone():
+            return 0, before, before
+        has_lru = db.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='lru'").fetchone()
+        keys = [x for x, in db.execute("SELECT key FROM responses")]
+        rewritten = 0
+        for start in range(0, len(keys), BATCH):
+            with db:
+                for key in keys[start:start + BATCH]:
+                    value = bytes(db.execute("SELECT value FROM responses WHERE key=?", (key,)).fetchone()[0])
+                    if value.startswith(new.header):
+                        continue
+                    try:
+                        response = old.loads(value)
+                    except Exception:
+                        # unreadable anyway, it is fetched again when needed
+                        continue
+                    if not new.compressible(response):
+                        continue
+                    migrated = new.dumps(response)
+                    db.execute("UPDATE responses SET value=? WHERE key=?", (migrated, key))
+                    if has_lru:
+                        db.execute("UPDATE lru SET size=? WHERE key=?", (len(migrated), key))
+                    rewritten += 1
+        if rewritten:
+            db.execute("VACUUM")
+    finally:
+        db.close()
+    return rewritten, before, os.path.getsize(path)
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("caches", nargs="+", help="url cache files or directories of them")
+    parser.add_argument("--dictionary", help="dictionary the existing entries were compressed with, if not the current one")
+    arguments = parser.parse_args()
+
+    new = CompressingSerializer()
+    old = new
+    if arguments.dictionary:
+        with open(arguments.dictionary, "rb") as f:
+            old = CompressingSerializer(f.read())
+
+    total_before = total_after = 0
+    for path in cache_files(arguments.caches):
+        rewritten, before, after = migrate(path, old, new)
+        total_before += before
+        total_after += after
+        print(f"{path}: {rewritten} entries compressed, {before / 1024 / 1024:.1f} MB -> {after / 1024 / 1024:.1f} MB")
+    print(f"total: {total_before / 1024 / 1024:.1f} MB -> {total_after / 1024 / 1024:.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+# Trains the dictionary the url caches compress pages with, from html files or from the pages of existing caches.
+# Entries compressed with the previous dictionary become cache misses, run util/migrate_cache.py with
+# --dictionary set to the old one first to keep them.
+# python util/train_cache_dictionary.py ~/.cache/lparchive2epub/http_cache.sqlite -o lparchive2epub/lparchive.zdict
+import os
+import sqlite3
+from argparse import ArgumentParser
+from typing import Iterator
+
+from lparchive2epub.compression import DICTIONARY_SIZE, CompressingSerializer, train_dictionary
+
+# enough pages for the markup they share to stand out
+MAX_SAMPLES = 2000
+
+
+def cached_pages(path: str, serializer: CompressingSerializer) -> Iterator[bytes]:
+    db = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        if not db.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='responses'").fetchone():
+            return
+        for value, in db.execute("SELECT value FROM responses"):
+            try:
+                response = serializer.loads(value)
+            except Exception:
+                continue
+            if serializer.compressible(response) and response._body:
+                yield response._body
+    finally:
+        db.close()
+
+
+def samples(paths: list[str], serializer: CompressingSerializer) -> Iterator[bytes]:
+    for path in paths:
+        if os.path.isdir(path):
+            yield from samples([os.path.join(path, x) for x in sorted(os.listdir(path))], serializer)
+        elif path.endswith((".html", ".htm")):
+            with open(path, "rb") as f:
+                yield f.read()
+        elif path.endswith(".sqlite"):
+            yield from cached_pages(path, serializer)
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("sources", nargs="+", help="html files, url caches or directories holding them")
+    parser.add_argument("-o", "--output", required=True)
+    parser.add_argument("--size", type=int, default=DICTIONARY_SIZE)
+    arguments = parser.parse_args()
+
+    serializer = CompressingSerializer()
+    pages = []
+    for page in samples(arguments.sources, serializer):
+        pages.append(page)
+        if len(pages) == MAX_SAMPLES:
+            break
+    if not pages:
+        parser.error("no pages found")
+    dictionary = train_dictionary(pages, arguments.size)
+    with open(arguments.output, "wb") as f:
+        f.write(dictionary)
+    print(f"{len(dictionary)} bytes trained on {len(pages)} pages")
+
+
+if __name__ == "__main__":
+    main()